@@ -24,4 +24,14 @@
 @Date       : 2024/8/11 下午8:27
 """
 
-from .rander.img import quote,quote_twitter
+__all__ = ['quote', 'quote_twitter', 'warm_up', 'quote_async', 'quote_twitter_async']
+_modules = {'quote': '.rander.img', 'quote_twitter': '.rander.img', 'warm_up': '.rander.img',
+            'quote_async': '.aio', 'quote_twitter_async': '.aio'}
+
+
+def __getattr__(name):
+    # 首次访问时才导入渲染模块, import anyquote 本身不加载 PIL 和字体相关的依赖
+    if name in _modules:
+        import importlib
+        return getattr(importlib.import_module(_modules[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : aio.py
+
+@Author     : hsn
+
+@Date       : 2024/9/1 下午2:10
+"""
+import asyncio
+import functools
+import weakref
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable
+from urllib.parse import urlsplit
+
+from PIL import Image
+
+from .rander.img import quote
+
+FETCH_BACKENDS = ('browser', 'http')
+
+
+class IOLimiter:
+    """
+    限制同时进行的网络请求: 总数不超过 total, 每个域名不超过 per_host.
+    阻塞的请求在独立的线程池里执行, 不占用渲染用的线程.
+    信号量按事件循环分别创建, 同一个 IOLimiter 可以在多个事件循环里使用.
+    """
+
+    def __init__(self, total: int = 64, per_host: int = 8):
+        self.total = total
+        self.per_host = per_host
+        self.executor = ThreadPoolExecutor(max_workers=total, thread_name_prefix='anyquote-io')
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _semaphores(self, host: str):
+        loop = asyncio.get_running_loop()
+        if loop not in self._loops:
+            self._loops[loop] = (asyncio.Semaphore(self.total), {})
+        total, hosts = self._loops[loop]
+        if host not in hosts:
+            hosts[host] = asyncio.Semaphore(self.per_host)
+        return total, hosts[host]
+
+    async def run(self, url: str, func: Callable, *args, **kwargs):
+        """
+        在 I/O 线程池里执行 func(*args, **kwargs), url 用于区分域名
+        """
+        total, host = self._semaphores(urlsplit(url).netloc)
+        # wait for the host first, so that a request blocked on a busy host does not hold a global slot
+        async with host, total:
+            return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                    functools.partial(func, *args, **kwargs))
+
+
+default_limiter = IOLimiter()
+
+
+async def quote_async(user_name: str, user_avatar: Image, context: str, _time: datetime, user_id: str = "",
+                      medias: list[Image] = None, source: str = "", *, executor: Executor = None):
+    """
+    在 executor 中执行 quote(), 不阻塞事件循环. executor 为 None 时使用事件循环默认的线程池,
+    传入 ProcessPoolExecutor 可以让渲染用上多个核
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(
+        quote, user_name=user_name, user_avatar=user_avatar, context=context, _time=_time, user_id=user_id,
+        medias=medias, source=source))
+
+
+def fetch_tweet(url: str, backend: str = 'browser'):
+    """
+    按 backend 抓取推文, 结果经过 tweet_cache
+    """
+    from .internet.tweet import tweet_cache, tweet_id_from_url
+
+    if backend not in FETCH_BACKENDS:
+        raise ValueError(f'Unknown fetch backend: {backend!r}, expected one of {FETCH_BACKENDS}')
+    tweet_id = tweet_id_from_url(url)
+    if backend == 'http':
+        from .internet.graphql import get_guest_client
+        return tweet_cache.get_or_fetch(tweet_id, lambda: get_guest_client().get_tweet(tweet_id))
+    from .internet.twi import fetch_tweet as fetch_tweet_browser
+    return tweet_cache.get_or_fetch(tweet_id, lambda: fetch_tweet_browser(url))
+
+
+async def quote_twitter_async(url: str, *, backend: str = 'browser', fetch: Callable = None,
+                              executor: Executor = None, limiter: IOLimiter = None):
+    """
+    异步版本的 quote_twitter: 推文, 头像和媒体的下载在 limiter 中并发进行, 渲染交给 executor.
+    fetch 可以替换抓取函数, 接收 url 返回 Tweet
+    """
+    from .internet.avatar import load_avatar, load_image
+
+    limiter = limiter or default_limiter
+    if fetch is None:
+        fetch = functools.partial(fetch_tweet, backend=backend)
+    tweet = await limiter.run(url, fetch, url)
+    media_urls = [media['media_url_https'] for media in tweet.medias or [] if media.get('media_url_https')]
+    user_avatar, *medias = await asyncio.gather(
+        limiter.run(tweet.user_avatar_url, load_avatar, tweet.user_avatar_url),
+        *(limiter.run(media_url, load_image, media_url) for media_url in media_urls))
+    return await quote_async(user_name=tweet.user_name, user_avatar=user_avatar, context=tweet.context,
+                             _time=tweet.created_at, user_id=tweet.user_id, medias=medias, source=url,
+                             executor=executor)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : batch.py
+
+@Author     : hsn
+
+@Date       : 2024/9/2 上午11:00
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from PIL import Image
+
+from .rander.img import quote, quote_to, warm_up
+
+
+def render_job(job: dict):
+    """
+    在工作进程中渲染一个任务. job 为 quote() 的参数, 另外支持:
+    user_avatar 为图片路径, _time 为 ISO 格式字符串, output 为输出路径 (此时保存后只返回路径, 不回传图像)
+    """
+    job = dict(job)
+    output = job.pop('output', None)
+    if isinstance(job.get('user_avatar'), (str, os.PathLike)):
+        with Image.open(job['user_avatar']) as avatar:
+            job['user_avatar'] = avatar.convert('RGB')
+    elif job.get('user_avatar') is None:
+        job['user_avatar'] = Image.new('RGB', (150, 150), (200, 200, 200))
+    if isinstance(job.get('_time'), str):
+        job['_time'] = datetime.fromisoformat(job['_time'])
+    if output is None:
+        return quote(**job)
+    # 直接按输出文件的扩展名编码
+    quote_to(output, format=Path(output).suffix.lstrip('.'), **job)
+    return output
+
+
+class BatchRenderer:
+    """
+    用进程池并行渲染. 工作进程启动时调用 warm_up() 预加载字体, 之后一直复用.
+    同时提交的任务不超过 max_in_flight 个, 任务按需从输入中读取, 内存占用不随任务数增长.
+    """
+
+    def __init__(self, processes: int = None, *, max_in_flight: int = None):
+        self.processes = processes or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or self.processes * 2
+        self.executor = ProcessPoolExecutor(self.processes, initializer=warm_up)
+        self.completed = 0
+        self.failed = 0
+        self.elapsed = 0.0
+
+    def map(self, jobs: Iterable[dict]) -> Iterator[tuple[int, object]]:
+        """
+        按完成顺序产出 (任务序号, 结果). 结果为图像, 输出路径, 或任务抛出的异常
+        """
+        jobs = iter(enumerate(jobs))
+        pending = {}
+        start = time.perf_counter()
+        try:
+            while True:
+                while len(pending) < self.max_in_flight:
+                    try:
+                        index, job = next(jobs)
+                    except StopIteration:
+                        break
+                    pending[self.executor.submit(render_job, job)] = index
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    try:
+                        result = future.result()
+                        self.completed += 1
+                    except Exception as e:
+                        result = e
+                        self.failed += 1
+                    yield index, result
+        finally:
+            for future in pending:
+                future.cancel()
+            self.elapsed += time.perf_counter() - start
+
+    def throughput(self):
+        seconds = self.elapsed or float('inf')
+        # 进程数多于核数时按实际能用的核数计算
+        cores = min(self.processes, os.cpu_count() or 1)
+        return {'quotes': self.completed, 'failed': self.failed, 'seconds': self.elapsed, 'cores': cores,
+                'quotes_per_second': self.completed / seconds,
+                'quotes_per_second_per_core': self.completed / seconds / cores}
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def quote_many(jobs: Iterable[dict], *, processes: int = None, max_in_flight: int = None):
+    """
+    并行渲染多个 quote, 按完成顺序产出 (任务序号, 结果), 参见 BatchRenderer.map
+    """
+    with BatchRenderer(processes, max_in_flight=max_in_flight) as renderer:
+        yield from renderer.map(jobs)
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(prog='python -m anyquote.batch',
+                                     description='按 JSON Lines 文件批量渲染 quote, 每行为 quote() 的参数')
+    parser.add_argument('jobs', type=Path, help='任务文件, 每行一个 JSON 对象')
+    parser.add_argument('output', type=Path, help='输出目录')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='工作进程数, 默认为 CPU 核数')
+    parser.add_argument('--in-flight', type=int, default=None, help='同时提交的任务数上限, 默认为进程数的两倍')
+    parser.add_argument('--format', default='png', help='输出格式: png, webp 或 jpeg')
+    parser.add_argument('--band-height', type=int, default=None,
+                        help='按这么多行分段渲染并流式写入, 每个进程的内存占用与正文长度无关 (只支持 png)')
+    args = parser.parse_args(argv)
+    if args.band_height is not None and args.format.lower() != 'png':
+        parser.error('--band-height only supports --format png')
+    options = {} if args.band_height is None else {'band_height': args.band_height}
+    args.output.mkdir(parents=True, exist_ok=True)
+
+    def jobs():
+        with args.jobs.open(encoding='utf-8') as f:
+            for index, line in enumerate(filter(str.strip, f)):
+                yield {**options, **json.loads(line), 'output': str(args.output / f'{index}.{args.format}')}
+
+    with BatchRenderer(args.processes, max_in_flight=args.in_flight) as renderer:
+        for index, result in renderer.map(jobs()):
+            if isinstance(result, Exception):
+                print(f'{index}: {result!r}', file=sys.stderr)
+        stats = renderer.throughput()
+    print(f"{stats['quotes']} quotes ({stats['failed']} failed) in {stats['seconds']:.2f}s: "
+          f"{stats['quotes_per_second']:.2f} quotes/s, {stats['quotes_per_second_per_core']:.2f} quotes/s per core "
+          f"({renderer.processes} processes, {stats['cores']} cores)")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : cache.py
+
+@Author     : hsn
+
+@Date       : 2024/8/26 下午9:14
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Hashable
+
+
+def cache_dir(*parts: str) -> Path:
+    """
+    磁盘缓存目录, 默认为 ~/.cache/anyquote, 可以用环境变量 ANYQUOTE_CACHE_DIR 修改
+    """
+    base = os.environ.get('ANYQUOTE_CACHE_DIR') or Path.home() / '.cache' / 'anyquote'
+    return Path(base, *parts)
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存. maxsize 限制条目数, maxcost 限制总开销 (每项开销由 cost 计算), 为 None 时不限制.
+    """
+
+    def __init__(self, maxsize: int = None, maxcost: int = None, cost: Callable[[Any], int] = None):
+        self.maxsize = maxsize
+        self.maxcost = maxcost
+        self.cost = cost or (lambda value: 1)
+        self._data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value):
+        cost = self.cost(value)
+        with self._lock:
+            if key in self._data:
+                self.total_cost -= self._data.pop(key)[1]
+            if self.maxcost is not None and cost > self.maxcost:
+                return
+            self._data[key] = (value, cost)
+            self.total_cost += cost
+            while ((self.maxsize is not None and len(self._data) > self.maxsize) or
+                   (self.maxcost is not None and self.total_cost > self.maxcost)):
+                _, (_, evicted_cost) = self._data.popitem(last=False)
+                self.total_cost -= evicted_cost
+                self.evictions += 1
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]):
+        """
+        命中时返回缓存的值, 否则调用 factory 生成并放入缓存. factory 在锁外执行, 并发时可能被调用多次.
+        """
+        _missing = object()
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def pop(self, key: Hashable, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, cost = self._data.pop(key)
+            self.total_cost -= cost
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_cost = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'size': len(self._data), 'cost': self.total_cost}
+
+    def __contains__(self, key: Hashable):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
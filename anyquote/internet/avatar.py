@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : avatar.py
+
+@Author     : hsn
+
+@Date       : 2024/8/30 下午3:30
+"""
+import hashlib
+import os
+import threading
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+
+import requests
+from PIL import Image, PngImagePlugin
+
+from ..cache import LRUCache, cache_dir
+from .graphql import shared_session
+
+AVATAR_SIZE = 150
+
+
+@dataclass
+class Avatar:
+    image: Image.Image
+    etag: str = None
+    last_modified: str = None
+    checked: float = 0.0
+
+
+def decode_avatar(raw: bytes, size: int = AVATAR_SIZE) -> Image.Image:
+    """
+    解码并缩小到 size x size. JPEG 用 draft 直接按缩小后的尺寸解码
+    """
+    img = Image.open(BytesIO(raw))
+    img.draft('RGB', (size, size))
+    return img.convert('RGB').resize((size, size), Image.Resampling.LANCZOS)
+
+
+class AvatarCache:
+    """
+    按 (url, 像素尺寸) 缓存已解码并缩小的头像: 内存里是有上限的 LRU, 磁盘上每个条目一个 PNG 文件
+    (文件名为 url 和尺寸的 sha256), 总大小超过 max_disk_bytes 时删除最久未使用的文件.
+    size 为默认尺寸, get() 可以按渲染宽度另给尺寸.
+    超过 max_age 秒的条目用 ETag / Last-Modified 做条件请求, 304 或网络出错时继续使用缓存.
+    返回的图像是共享的, 调用方不要修改.
+    """
+
+    def __init__(self, session: requests.Session = None, *, directory: str | os.PathLike = None,
+                 size: int = AVATAR_SIZE, max_age: float = 24 * 3600, max_memory_items: int = 256,
+                 max_disk_bytes: int = 64 * 1024 * 1024, timeout: float = 10):
+        self.session = session or shared_session()
+        self.directory = Path(directory) if directory else cache_dir('avatars')
+        self.size = size
+        self.max_age = max_age
+        self.max_disk_bytes = max_disk_bytes
+        self.timeout = timeout
+        self.memory = LRUCache(maxsize=max_memory_items)
+        self.fetches = 0
+        self.revalidations = 0
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = None
+
+    def get(self, url: str, size: int = None) -> Image.Image:
+        size = size or self.size
+        entry = self.memory.get((url, size))
+        if entry is None:
+            entry = self._read(url, size)
+            if entry is not None:
+                self.memory.put((url, size), entry)
+        if entry is None or time.time() - entry.checked >= self.max_age:
+            try:
+                entry = self._fetch(url, size, entry)
+            except requests.RequestException:
+                if entry is None:
+                    raise
+                # 重新验证失败时先用旧的头像
+                return entry.image
+            self.memory.put((url, size), entry)
+        return entry.image
+
+    def _fetch(self, url: str, size: int, entry: Avatar = None):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and entry is not None:
+            self.revalidations += 1
+            entry = Avatar(entry.image, entry.etag, entry.last_modified)
+        else:
+            resp.raise_for_status()
+            self.fetches += 1
+            entry = Avatar(decode_avatar(resp.content, size), resp.headers.get('ETag'),
+                           resp.headers.get('Last-Modified'))
+        entry.checked = time.time()
+        self._write(url, size, entry)
+        return entry
+
+    def path(self, url: str, size: int = None) -> Path:
+        return self.directory / f'{hashlib.sha256(f"{url}@{size or self.size}".encode()).hexdigest()}.png'
+
+    def _read(self, url: str, size: int):
+        path = self.path(url, size)
+        try:
+            with Image.open(path) as img:
+                img.load()
+                meta = img.text
+                image = img.convert('RGB')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return Avatar(image, meta.get('etag') or None, meta.get('last-modified') or None,
+                      float(meta.get('checked', 0)))
+
+    def _write(self, url: str, size: int, entry: Avatar):
+        info = PngImagePlugin.PngInfo()
+        info.add_text('url', url)
+        info.add_text('etag', entry.etag or '')
+        info.add_text('last-modified', entry.last_modified or '')
+        info.add_text('checked', repr(entry.checked))
+        path = self.path(url, size)
+        tmp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            old_size = path.stat().st_size if path.exists() else 0
+            entry.image.save(tmp, 'PNG', pnginfo=info)
+            size = tmp.stat().st_size
+            os.replace(tmp, path)
+        except OSError:
+            # 磁盘缓存只是加速, 写失败时忽略
+            tmp.unlink(missing_ok=True)
+            return
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(f.stat().st_size for f in self.directory.glob('*.png'))
+            else:
+                self._disk_bytes += size - old_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict(keep=path)
+
+    def _evict(self, keep: Path):
+        files = []
+        for f in self.directory.glob('*.png'):
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        # 删到上限的 90%, 避免每次写入都要扫描目录
+        for _, size, f in files:
+            if total <= self.max_disk_bytes * 0.9:
+                break
+            if f == keep:
+                continue
+            f.unlink(missing_ok=True)
+            total -= size
+        self._disk_bytes = total
+
+    def stats(self):
+        return {'memory': self.memory.stats(), 'fetches': self.fetches, 'revalidations': self.revalidations,
+                'disk_bytes': self._disk_bytes}
+
+
+_default_cache: AvatarCache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_avatar_cache() -> AvatarCache:
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = AvatarCache()
+        return _default_cache
+
+
+def load_avatar(url: str, size: int = AVATAR_SIZE) -> Image.Image:
+    """
+    size 为头像的像素边长, 按输出宽度计算可以用 rander.img.avatar_size()
+    """
+    return get_avatar_cache().get(url, size)
+
+
+def load_image(url: str, *, session: requests.Session = None, timeout: float = 10) -> Image.Image:
+    """
+    下载并解码图片 (推文中的媒体), 不做缓存
+    """
+    resp = (session or shared_session()).get(url, timeout=timeout)
+    resp.raise_for_status()
+    img = Image.open(BytesIO(resp.content))
+    img.load()
+    return img
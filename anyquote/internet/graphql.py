@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : graphql.py
+
+@Author     : hsn
+
+@Date       : 2024/8/29 下午4:05
+"""
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .tweet import Tweet, parse_tweet
+
+# 网页版使用的公开 bearer token
+BEARER_TOKEN = ('AAAAAAAAAAAAAAAAAAAAANRILgAAAAAAnNwIzUejRCOuH5E6I8xnZz4puTs%3D'
+                '1Zv7ttfk8LF81IUq16cHjhLTvJu4FA33AGWWjCpTnA')
+ACTIVATE_URL = 'https://api.twitter.com/1.1/guest/activate.json'
+GRAPHQL_URL = 'https://twitter.com/i/api/graphql'
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'
+
+
+def new_session(pool_size: int = 10) -> requests.Session:
+    """
+    带连接池的 requests.Session, keep-alive 复用连接
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+_shared_session: requests.Session = None
+_shared_session_lock = threading.Lock()
+
+
+def shared_session() -> requests.Session:
+    """
+    进程内共享的 Session, GraphQL 请求和头像下载复用同一个连接池
+    """
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = new_session()
+        return _shared_session
+
+
+class GuestClient:
+    """
+    不启动浏览器, 用游客 token 直接请求 TweetResultByRestId 接口.
+    session 即传输层, 可以换成挂了自定义 adapter 的 Session; activate_url / graphql_url 可以指向本地的替身服务.
+    token 超过 token_ttl 秒, 或接口返回 401/403/429 时重新获取.
+    """
+    REFRESH_STATUS = (401, 403, 429)
+
+    def __init__(self, session: requests.Session = None, *, activate_url: str = ACTIVATE_URL,
+                 graphql_url: str = GRAPHQL_URL, bearer_token: str = BEARER_TOKEN, token_ttl: float = 2 * 3600,
+                 timeout: float = 10):
+        self.session = session or shared_session()
+        self.activate_url = activate_url
+        self.graphql_url = graphql_url
+        self.bearer_token = bearer_token
+        self.token_ttl = token_ttl
+        self.timeout = timeout
+        self._token = None
+        self._token_time = 0.0
+        self._lock = threading.Lock()
+
+    def guest_token(self, *, refresh: bool = False) -> str:
+        with self._lock:
+            if refresh or self._token is None or time.monotonic() - self._token_time > self.token_ttl:
+                resp = self.session.post(self.activate_url, headers={'Authorization': f'Bearer {self.bearer_token}'},
+                                         timeout=self.timeout)
+                resp.raise_for_status()
+                self._token = resp.json()['guest_token']
+                self._token_time = time.monotonic()
+            return self._token
+
+    def get_tweet_json(self, tweet_id: str | int) -> dict:
+        from twitter.constants import Operation
+
+        _, qid, name = Operation.TweetResultByRestId
+        params = {
+            'variables': json.dumps(Operation.default_variables | {'tweetId': str(tweet_id)}),
+            'features': json.dumps(Operation.default_features),
+        }
+        token = self.guest_token()
+        for retry in (True, False):
+            resp = self.session.get(f'{self.graphql_url}/{qid}/{name}', params=params, timeout=self.timeout, headers={
+                'Authorization': f'Bearer {self.bearer_token}',
+                'x-guest-token': token,
+                'content-type': 'application/json',
+            })
+            if resp.status_code in self.REFRESH_STATUS and retry:
+                token = self.guest_token(refresh=True)
+                continue
+            resp.raise_for_status()
+            return resp.json()
+
+    def get_tweet(self, tweet_id: str | int) -> Tweet:
+        j = self.get_tweet_json(tweet_id)
+        result = j.get('data', {}).get('tweetResult', {}).get('result')
+        if not result:
+            raise Exception("No data found")
+        return parse_tweet(result)
+
+
+_default_client: GuestClient = None
+_default_client_lock = threading.Lock()
+
+
+def get_guest_client() -> GuestClient:
+    """
+    进程内共享的 GuestClient, 首次使用时创建
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = GuestClient()
+        return _default_client
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : pool.py
+
+@Author     : hsn
+
+@Date       : 2024/8/27 下午2:40
+"""
+import atexit
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from selenium import webdriver
+from selenium.common import WebDriverException
+from selenium.webdriver.chrome.options import Options
+
+
+@functools.cache
+def chromium_driver_path():
+    """
+    chromedriver 的路径只解析一次, ChromeDriverManager.install() 每次都会检查版本和下载
+    """
+    from webdriver_manager.chrome import ChromeDriverManager, ChromeType
+    return ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install()
+
+
+def chromium_factory() -> webdriver.Chrome:
+    options = Options()
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    options.add_argument("--headless")
+    return webdriver.Chrome(options=options, service=webdriver.ChromeService(chromium_driver_path()))
+
+
+def reset_driver(driver: webdriver.Chrome):
+    """
+    清掉上一次抓取留下的状态: 当前页面, cookies 和性能日志.
+    先离开页面, 否则旧页面在清日志之后发出的请求还会留在日志里
+    """
+    driver.get("about:blank")
+    # delete_all_cookies 只删当前域名的 cookies, 在 about:blank 上不起作用
+    driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+    driver.get_log("performance")
+
+
+class DriverPool:
+    """
+    有上限的 WebDriver 池. 浏览器按需创建并保持常驻, 每次抓取借出一个, 归还时重置状态.
+    使用满 max_uses 次或抛出 WebDriverException 的浏览器会被关闭, 之后按需重新创建.
+    """
+
+    def __init__(self, size: int = 2, *, factory: Callable[[], webdriver.Chrome] = chromium_factory,
+                 reset: Callable[[webdriver.Chrome], None] = reset_driver, max_uses: int = 50):
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.size = size
+        self.factory = factory
+        self.reset = reset
+        self.max_uses = max_uses
+        self._idle: list = []
+        self._count = 0
+        self._uses: dict[int, int] = {}
+        self._leased_at: dict[int, float] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._started = time.perf_counter()
+        self.created = 0
+        self.recycled = 0
+        self.leases = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+
+    @property
+    def in_use(self):
+        return self._count - len(self._idle)
+
+    def acquire(self, timeout: float = None):
+        """
+        借出一个浏览器, 池满时最多等待 timeout 秒, 超时抛出 TimeoutError
+        """
+        start = time.perf_counter()
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError('DriverPool is closed')
+                if self._idle:
+                    driver = self._idle.pop()
+                    break
+                if self._count < self.size:
+                    # 先占住名额, 在锁外启动浏览器
+                    self._count += 1
+                    driver = None
+                    break
+                remaining = None if timeout is None else timeout - (time.perf_counter() - start)
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'No driver available within {timeout}s')
+                self._cond.wait(remaining)
+        if driver is None:
+            try:
+                driver = self.factory()
+            except BaseException:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify()
+                raise
+        now = time.perf_counter()
+        with self._cond:
+            if id(driver) not in self._uses:
+                self._uses[id(driver)] = 0
+                self.created += 1
+            self._leased_at[id(driver)] = now
+            self.leases += 1
+            self.wait_time += now - start
+            self.max_wait = max(self.max_wait, now - start)
+        return driver
+
+    def release(self, driver, *, broken: bool = False):
+        """
+        归还浏览器. broken 为 True, 用满 max_uses 次, 或重置失败时关闭它
+        """
+        with self._cond:
+            self.busy_time += time.perf_counter() - self._leased_at.pop(id(driver))
+            self._uses[id(driver)] += 1
+            retire = broken or self._closed or self._uses[id(driver)] >= self.max_uses
+        if not retire:
+            try:
+                self.reset(driver)
+            except WebDriverException:
+                retire = True
+        with self._cond:
+            if retire:
+                del self._uses[id(driver)]
+                self._count -= 1
+                self.recycled += 1
+            else:
+                self._idle.append(driver)
+            self._cond.notify()
+        if retire:
+            self._quit(driver)
+
+    @contextmanager
+    def lease(self, timeout: float = None):
+        driver = self.acquire(timeout)
+        try:
+            yield driver
+        except WebDriverException:
+            self.release(driver, broken=True)
+            raise
+        except BaseException:
+            self.release(driver)
+            raise
+        else:
+            self.release(driver)
+
+    def warm(self, count: int = None):
+        """
+        预先启动 count 个浏览器 (默认填满池)
+        """
+        drivers = [self.acquire() for _ in range(min(count or self.size, self.size))]
+        for driver in drivers:
+            self.release(driver)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            for driver in idle:
+                del self._uses[id(driver)]
+            self._count -= len(idle)
+            self._cond.notify_all()
+        for driver in idle:
+            self._quit(driver)
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+    def stats(self):
+        with self._cond:
+            uptime = time.perf_counter() - self._started
+            return {'size': self.size, 'in_use': self.in_use, 'idle': len(self._idle), 'created': self.created,
+                    'recycled': self.recycled, 'leases': self.leases,
+                    'avg_wait': self.wait_time / self.leases if self.leases else 0.0, 'max_wait': self.max_wait,
+                    'utilisation': self.busy_time / (self.size * uptime) if uptime else 0.0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_pool: DriverPool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_driver_pool() -> DriverPool:
+    """
+    get_tweet_info 默认使用的全局池, 首次使用时创建, 退出时关闭全部浏览器
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = DriverPool()
+            atexit.register(_default_pool.close)
+        return _default_pool
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : tweet.py
+
+@Author     : hsn
+
+@Date       : 2024/8/31 上午10:20
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from os import PathLike
+from typing import Callable
+
+from ..cache import LRUCache, cache_dir
+
+
+@dataclass(slots=True)
+class Tweet:
+    id: str
+    user_name: str
+    user_id: str
+    user_avatar_url: str
+    context: str
+    medias: list
+    created_at: datetime
+
+    def to_dict(self):
+        data = asdict(self)
+        data['created_at'] = self.created_at.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**{**data, 'created_at': datetime.fromisoformat(data['created_at'])})
+
+
+def tweet_id_from_url(url: str) -> str:
+    """
+    从 https://x.com/<user>/status/<id> 形式的链接 (或纯数字 id) 中取出推文 id
+    """
+    match = re.search(r'(?:^|/status(?:es)?/)(\d+)', str(url))
+    if not match:
+        raise ValueError(f'Can not find tweet id in {url!r}')
+    return match.group(1)
+
+
+def parse_tweet(result: dict) -> Tweet:
+    """
+    解析 GraphQL 返回的 tweetResult.result, 每一层只取一次. 浏览器抓取, 登录抓取和 HTTP 抓取共用.
+    """
+    if result.get('__typename') == 'TweetWithVisibilityResults':
+        result = result['tweet']
+    legacy = result['legacy']
+    user = result['core']['user_results']['result']['legacy']
+    # /note_tweet/note_tweet_results/result/text
+    context = result.get('note_tweet', {}).get('note_tweet_results', {}).get('result', {}).get('text')
+    if not context:
+        # 去掉末尾指向媒体的 t.co 链接
+        full_text: str = legacy['full_text']
+        cut = full_text.rfind('https://t.co/')
+        context = full_text[:cut] if cut != -1 else full_text
+    return Tweet(
+        id=result.get('rest_id') or legacy.get('id_str'),
+        user_name=user['name'],
+        user_id=user['screen_name'],
+        user_avatar_url=user['profile_image_url_https'].replace('_normal.jpg', '.jpg'),
+        context=context,
+        medias=legacy.get('entities', {}).get('media'),
+        created_at=datetime.strptime(legacy['created_at'], "%a %b %d %H:%M:%S %z %Y"),
+    )
+
+
+class MemoryTweetStore:
+    """
+    进程内的 LRU 存储
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def get(self, tweet_id: str):
+        return self._cache.get(tweet_id)
+
+    def put(self, tweet_id: str, tweet: Tweet, expires: float):
+        self._cache.put(tweet_id, (tweet, expires))
+
+    def delete(self, tweet_id: str):
+        self._cache.pop(tweet_id)
+
+
+class SQLiteTweetStore:
+    """
+    本地 SQLite 文件存储, 同一台机器上的多个进程可以共用. 超过 maxsize 条时删除最久未访问的记录
+    """
+
+    def __init__(self, path: str | PathLike = None, maxsize: int = 100000):
+        if path is None:
+            cache_dir().mkdir(parents=True, exist_ok=True)
+            path = cache_dir('tweets.sqlite3')
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS tweets '
+                         '(id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tweets_accessed ON tweets (accessed)')
+
+    def get(self, tweet_id: str):
+        with self._lock:
+            row = self._db.execute('SELECT data, expires FROM tweets WHERE id = ?', (tweet_id,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE tweets SET accessed = ? WHERE id = ?', (time.time(), tweet_id))
+        return Tweet.from_dict(json.loads(row[0])), row[1]
+
+    def put(self, tweet_id: str, tweet: Tweet, expires: float):
+        data = json.dumps(tweet.to_dict(), ensure_ascii=False)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO tweets VALUES (?, ?, ?, ?)', (tweet_id, data, expires, time.time()))
+            self._db.execute('DELETE FROM tweets WHERE id IN '
+                             '(SELECT id FROM tweets ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+    def delete(self, tweet_id: str):
+        with self._lock:
+            self._db.execute('DELETE FROM tweets WHERE id = ?', (tweet_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class TweetCache:
+    """
+    按推文 id 缓存解析后的 Tweet, 超过 ttl 秒后重新抓取. store 可以是 MemoryTweetStore 或 SQLiteTweetStore.
+    每次 get() 都计入 hits / misses
+    """
+
+    def __init__(self, store: MemoryTweetStore | SQLiteTweetStore = None, ttl: float = 3600):
+        self.store = store or MemoryTweetStore()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, tweet_id: str) -> Tweet | None:
+        tweet = self._lookup(str(tweet_id))
+        with self._lock:
+            if tweet is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tweet
+
+    def _lookup(self, tweet_id: str) -> Tweet | None:
+        entry = self.store.get(tweet_id)
+        if entry is None:
+            return None
+        tweet, expires = entry
+        if expires <= time.time():
+            self.store.delete(tweet_id)
+            return None
+        return tweet
+
+    def put(self, tweet: Tweet):
+        self.store.put(str(tweet.id), tweet, time.time() + self.ttl)
+
+    def get_or_fetch(self, tweet_id: str, fetch: Callable[[], Tweet]) -> Tweet:
+        tweet = self.get(tweet_id)
+        if tweet is not None:
+            return tweet
+        tweet = fetch()
+        self.store.put(str(tweet_id), tweet, time.time() + self.ttl)
+        return tweet
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+tweet_cache = TweetCache()
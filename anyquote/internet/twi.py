@@ -24,134 +24,225 @@
 @Date       : 2024/8/11 下午8:47
 """
 import json
-from datetime import datetime
-from io import BytesIO
+import re
+import threading
+import time
+from typing import Iterable
+from urllib.parse import unquote
 
-import requests
-from PIL import Image
 from selenium import webdriver
-from selenium.common import WebDriverException
-from selenium.webdriver.chrome.options import Options
 from twitter.scraper import Scraper
-from webdriver_manager.chrome import ChromeDriverManager, ChromeType
 
-
-def get_tweet_info_login(url: str):
-    s = Scraper(cookies=c)
-    j = s.tweets_by_ids([int(url.split('/')[-1])])[0]
-
-    user_name = j.get('data').get('tweetResult')[0].get('result').get('core').get('user_results').get('result').get(
-        'legacy').get('name')
-    # /data/tweetResult/result/legacy/entities/media
-    medias = j.get('data').get('tweetResult')[0].get('result').get('legacy').get('entities').get('media')
-    # /data/tweetResult/result/note_tweet/note_tweet_results/result/text
-    note_tweet = j.get('data', {}).get('tweetResult', {})[0].get('result', {}).get('note_tweet', {}).get(
-        'note_tweet_results', {}).get('result', {}).get('text', {})
-
-    # /data/tweetResult/result/legacy/full_text
-    full_text: str = j.get('data').get('tweetResult')[0].get('result').get('legacy').get('full_text')
-    if note_tweet:
-        context = note_tweet
-    else:
-        context = full_text[:full_text.rfind('https://t.co/')]
-    # /data/tweetResult/result/core/user_results/result/legacy/screen_name
-    user_id = j.get('data').get('tweetResult')[0].get('result').get('core').get('user_results').get('result').get(
-        'legacy').get('screen_name')
-    # /data/tweetResult/result/core/user_results/result/legacy/profile_image_url_https
-    user_avatar_url: str = j.get('data').get('tweetResult')[0].get('result').get('core').get('user_results').get(
-        'result').get(
-        'legacy').get('profile_image_url_https')
-    user_avatar_url = user_avatar_url.replace('_normal.jpg', '.jpg')
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'
-    }
-    # req = request.Request("https://pbs.twimg.com/profile_images/1601123559812009984/2vI25CZP_normal.jpg",headers=headers)
-    # proxy_host = 'http://localhost:7890'
-    # if proxy_host:
-    #     req.set_proxy(proxy_host, 'http')
-    #
-    # response = request.urlopen(req)
-    resp = requests.get(user_avatar_url, headers=headers)
-    user_avatar_raw = resp.content
-    user_avatar = Image.open(BytesIO(user_avatar_raw))
-
-    # /data/tweetResult/result/legacy/created_at
-    time_ctime = j.get('data').get('tweetResult')[0].get('result').get('legacy').get('created_at')
-    t = datetime.strptime(time_ctime, "%a %b %d %H:%M:%S %z %Y")
-
-    return user_name, user_id, user_avatar, context, medias, t
-
-
-def get_tweet_info(url: str, *, driver: webdriver.Chrome = None):
-    options = Options()
-    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
-    options.add_argument("--headless")
-    if not driver:
-        driver_path = ChromeDriverManager(chrome_type=ChromeType.CHROMIUM).install()
-        svc = webdriver.ChromeService(driver_path)
-        driver = webdriver.Chrome(options=options, service=svc)
-    driver.get(url)
-
-    performance_log = driver.get_log("performance")
-
-    for packet in performance_log:
-        message = json.loads(packet.get("message")).get("message")
-        packet_method = message.get("method")
-        if "Network" in packet_method:
-            request_id = message.get("params").get("requestId")
+from .avatar import AVATAR_SIZE, load_avatar
+from .graphql import GuestClient, get_guest_client
+from .pool import DriverPool, get_driver_pool
+from .tweet import Tweet, TweetCache, parse_tweet, tweet_cache, tweet_id_from_url
+
+
+def tweet_info(tweet: Tweet, *, avatar_size: int = AVATAR_SIZE):
+    """
+    把 Tweet 转换成 (user_name, user_id, user_avatar, context, medias, t), 头像缩放到 avatar_size 像素
+    """
+    return tweet.user_name, tweet.user_id, load_avatar(tweet.user_avatar_url, avatar_size), tweet.context, \
+        tweet.medias, tweet.created_at
+
+
+class TweetBatchFetcher:
+    """
+    登录后批量抓取推文: 复用同一个 Scraper, 每 chunk_size 个 id 调用一次 tweets_by_ids.
+    cookies 为 cookies 字典或 cookies 文件路径, 也可以直接传入已登录的 scraper.
+    """
+
+    def __init__(self, scraper: Scraper = None, *, cookies: dict | str = None, chunk_size: int = 100,
+                 cache: TweetCache = tweet_cache):
+        self.scraper = scraper or Scraper(cookies=cookies, save=False, pbar=False, debug=0)
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self._lock = threading.Lock()
+
+    def fetch(self, urls: Iterable[str | int]) -> list[Tweet | Exception]:
+        """
+        urls 可以是推文链接或 id. 按输入顺序返回, 单条失败时对应位置是异常对象而不是 Tweet
+        """
+        ids = []
+        for url in urls:
             try:
-                resp = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
-                body = resp.get("body")
-                j = json.loads(body)
-                if 'data' in j:
+                ids.append(tweet_id_from_url(url))
+            except ValueError as e:
+                ids.append(e)
+        found: dict[str, Tweet | Exception] = {}
+        missing = []
+        for tweet_id in dict.fromkeys(i for i in ids if not isinstance(i, Exception)):
+            tweet = self.cache.get(tweet_id) if self.cache is not None else None
+            if tweet is None:
+                missing.append(tweet_id)
+            else:
+                found[tweet_id] = tweet
+        for start in range(0, len(missing), self.chunk_size):
+            found.update(self._fetch_chunk(missing[start:start + self.chunk_size]))
+        return [i if isinstance(i, Exception) else found[i] for i in ids]
+
+    def _fetch_chunk(self, chunk: list[str]):
+        try:
+            # Scraper 内部用 asyncio.run, 同一个实例不要并发调用
+            with self._lock:
+                responses = self.scraper.tweets_by_ids(chunk)
+        except Exception as e:
+            return {tweet_id: e for tweet_id in chunk}
+        results = {}
+        for j in responses:
+            for item in (j.get('data') or {}).get('tweetResult') or []:
+                result = (item or {}).get('result')
+                if not result:
+                    continue
+                try:
+                    tweet = parse_tweet(result)
+                except (KeyError, TypeError, ValueError) as e:
+                    tweet_id = result.get('rest_id')
+                    if tweet_id:
+                        results[tweet_id] = LookupError(f'Can not parse tweet {tweet_id}: {e!r}')
+                    continue
+                results[tweet.id] = tweet
+                if self.cache is not None:
+                    self.cache.put(tweet)
+        for tweet_id in chunk:
+            results.setdefault(tweet_id, LookupError(f'Tweet {tweet_id} not found'))
+        return results
+
+
+_default_fetchers: dict[str, TweetBatchFetcher] = {}
+_default_fetchers_lock = threading.Lock()
+
+
+def get_tweet_fetcher(cookies: dict | str = None) -> TweetBatchFetcher:
+    """
+    进程内按 cookies 共享的 TweetBatchFetcher, 首次使用时创建并登录
+    """
+    key = json.dumps(cookies, sort_keys=True)
+    with _default_fetchers_lock:
+        if key not in _default_fetchers:
+            _default_fetchers[key] = TweetBatchFetcher(cookies=cookies)
+        return _default_fetchers[key]
+
+
+def get_tweets_login(urls: Iterable[str | int], *, cookies: dict | str = None,
+                     fetcher: TweetBatchFetcher = None) -> list[Tweet | Exception]:
+    return (fetcher or get_tweet_fetcher(cookies)).fetch(urls)
+
+
+def get_tweet_info_login(url: str, *, cookies: dict | str = None, fetcher: TweetBatchFetcher = None,
+                         avatar_size: int = AVATAR_SIZE):
+    tweet = get_tweets_login([url], cookies=cookies, fetcher=fetcher)[0]
+    if isinstance(tweet, Exception):
+        raise tweet
+    return tweet_info(tweet, avatar_size=avatar_size)
+
+
+TWEET_RESULT_ENDPOINT = 'TweetResultByRestId'
+_TWEET_ID_VARIABLE = re.compile(r'"(?:tweetId|focalTweetId)"\s*:\s*"(\d+)"')
+
+
+def _is_tweet_response(response_url: str, url_filter: str, tweet_id: str | None) -> bool:
+    """
+    响应链接包含 url_filter, 且 variables 里的推文 id 与 tweet_id 相同 (引用/嵌入的推文也会请求同一个接口)
+    """
+    if url_filter not in response_url:
+        return False
+    if tweet_id is None:
+        return True
+    return tweet_id in _TWEET_ID_VARIABLE.findall(unquote(response_url))
+
+
+def capture_tweet_json(driver: webdriver.Chrome, url: str, *, timeout: float = 20, poll: float = 0.05,
+                       url_filter: str = TWEET_RESULT_ENDPOINT):
+    """
+    打开 url 并等待 url_filter 对应的 GraphQL 响应, 只对这一条响应请求 body.
+    url 是推文链接时只接受该推文的响应.
+    只看性能日志里的 Network.requestWillBeSent / responseReceived / loadingFinished / loadingFailed 事件,
+    请求失败或返回非 2xx 时立即抛出异常, 超过 timeout 秒抛出 TimeoutError.
+    """
+    try:
+        tweet_id = tweet_id_from_url(url)
+    except ValueError:
+        tweet_id = None
+    # 复用的 driver 里可能还留着上一个页面的日志
+    driver.get_log("performance")
+    driver.get(url)
+    deadline = time.monotonic() + timeout
+    # 链接匹配的请求; 失败事件里没有链接, 只能按 requestId 对应
+    pending = set()
+    request_id = None
+    finished = False
+    while not finished:
+        for packet in driver.get_log("performance"):
+            raw = packet.get("message")
+            # 先按字符串过滤, 大部分事件不需要解析
+            if request_id is None and url_filter in raw and (tweet_id is None or tweet_id in raw) and \
+                    ('Network.requestWillBeSent' in raw or 'Network.responseReceived' in raw):
+                message = json.loads(raw)["message"]
+                params = message["params"]
+                if message["method"] == 'Network.requestWillBeSent':
+                    if _is_tweet_response(params["request"]["url"], url_filter, tweet_id):
+                        pending.add(params["requestId"])
+                elif message["method"] == 'Network.responseReceived':
+                    response = params["response"]
+                    if _is_tweet_response(response["url"], url_filter, tweet_id):
+                        if not 200 <= response.get("status", 200) < 300:
+                            raise Exception(f"{url_filter} returned HTTP {response['status']} "
+                                            f"{response.get('statusText', '')}".rstrip())
+                        request_id = params["requestId"]
+                        pending.add(request_id)
+            elif pending and 'Network.loadingFailed' in raw:
+                params = json.loads(raw)["message"]["params"]
+                if params["requestId"] in pending:
+                    raise Exception(f"{url_filter} request failed: {params.get('errorText') or 'unknown error'}")
+            elif request_id is not None and 'Network.loadingFinished' in raw and json.dumps(request_id) in raw:
+                message = json.loads(raw)["message"]
+                if message["method"] == 'Network.loadingFinished' and message["params"]["requestId"] == request_id:
+                    finished = True
                     break
-            except json.JSONDecodeError:
-                pass
-            except WebDriverException:
-                pass
-    else:
+        if not finished:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"No {url_filter} response within {timeout}s")
+            time.sleep(poll)
+
+    resp = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+    j = json.loads(resp.get("body"))
+    if 'data' not in j:
         raise Exception("No data found")
-    driver.quit()
-    # /data/tweetResult/result/core/user_results/result/legacy/name
-    user_name = j.get('data').get('tweetResult').get('result').get('core').get('user_results').get('result').get(
-        'legacy').get('name')
-    # /data/tweetResult/result/legacy/entities/media
-    medias = j.get('data').get('tweetResult').get('result').get('legacy').get('entities').get('media')
-    # /data/tweetResult/result/note_tweet/note_tweet_results/result/text
-    note_tweet = j.get('data', {}).get('tweetResult', {}).get('result', {}).get('note_tweet', {}).get(
-        'note_tweet_results', {}).get('result', {}).get('text', {})
-
-    # /data/tweetResult/result/legacy/full_text
-    full_text: str = j.get('data').get('tweetResult').get('result').get('legacy').get('full_text')
-    if note_tweet:
-        context = note_tweet
+    return j
+
+
+def fetch_tweet(url: str, *, driver: webdriver.Chrome = None, pool: DriverPool = None) -> Tweet:
+    """
+    传入 driver 时直接使用, 不会关闭它; 否则从 pool (默认为全局池) 借一个浏览器
+    """
+    if driver:
+        j = capture_tweet_json(driver, url)
     else:
-        context = full_text[:full_text.rfind('https://t.co/')]
-    # /data/tweetResult/result/core/user_results/result/legacy/screen_name
-    user_id = j.get('data').get('tweetResult').get('result').get('core').get('user_results').get('result').get(
-        'legacy').get('screen_name')
-    # /data/tweetResult/result/core/user_results/result/legacy/profile_image_url_https
-    user_avatar_url: str = j.get('data').get('tweetResult').get('result').get('core').get('user_results').get(
-        'result').get(
-        'legacy').get('profile_image_url_https')
-    user_avatar_url = user_avatar_url.replace('_normal.jpg', '.jpg')
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'
-    }
-    # req = request.Request("https://pbs.twimg.com/profile_images/1601123559812009984/2vI25CZP_normal.jpg",headers=headers)
-    # proxy_host = 'http://localhost:7890'
-    # if proxy_host:
-    #     req.set_proxy(proxy_host, 'http')
-    #
-    # response = request.urlopen(req)
-    # resp = requests.get(user_avatar_url, headers=headers,
-    #                     proxies={'http': 'http://localhost:7890', 'https': 'http://localhost:7890'})
-    resp = requests.get(user_avatar_url, headers=headers)
-    user_avatar_raw = resp.content
-    user_avatar = Image.open(BytesIO(user_avatar_raw))
-
-    # /data/tweetResult/result/legacy/created_at
-    time_ctime = j.get('data').get('tweetResult').get('result').get('legacy').get('created_at')
-    t = datetime.strptime(time_ctime, "%a %b %d %H:%M:%S %z %Y")
-
-    return user_name, user_id, user_avatar, context, medias, t
+        with (pool or get_driver_pool()).lease() as driver:
+            j = capture_tweet_json(driver, url)
+    return parse_tweet(j['data']['tweetResult']['result'])
+
+
+def get_tweet_info(url: str, *, driver: webdriver.Chrome = None, pool: DriverPool = None,
+                   cache: TweetCache = tweet_cache, avatar_size: int = AVATAR_SIZE):
+    """
+    用浏览器抓取推文. 结果按推文 id 缓存在 cache 中, 传入 None 时不使用缓存
+    """
+    if cache is None:
+        return tweet_info(fetch_tweet(url, driver=driver, pool=pool), avatar_size=avatar_size)
+    return tweet_info(cache.get_or_fetch(tweet_id_from_url(url), lambda: fetch_tweet(url, driver=driver, pool=pool)),
+                      avatar_size=avatar_size)
+
+
+def get_tweet_info_http(url: str, *, client: GuestClient = None, cache: TweetCache = tweet_cache,
+                        avatar_size: int = AVATAR_SIZE):
+    """
+    不启动浏览器, 通过游客 token 直接请求 GraphQL 接口. client 默认为进程内共享的 GuestClient
+    """
+    client = client or get_guest_client()
+    tweet_id = tweet_id_from_url(url)
+    if cache is None:
+        return tweet_info(client.get_tweet(tweet_id), avatar_size=avatar_size)
+    return tweet_info(cache.get_or_fetch(tweet_id, lambda: client.get_tweet(tweet_id)), avatar_size=avatar_size)
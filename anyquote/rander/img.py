@@ -23,17 +23,23 @@
 
 @Date       : 2024/8/11 下午8:48
 """
+import functools
+import struct
+import time
+import zlib
+from dataclasses import dataclass
 from datetime import datetime
+from os import PathLike
 from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, Iterator, Sequence
 
-import qrcode
 from PIL import Image, ImageDraw
-from qrcode.image.styledpil import StyledPilImage
-from qrcode.image.styles.moduledrawers import RoundedModuleDrawer
-from selenium import webdriver
 
-from .text import Font, TextBox, Text
-from ..internet.twi import get_tweet_info
+from ..cache import LRUCache
+from .text import TextBox, TextLayout, Text, FontChain, font_registry
+
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 
 def gen_rounded_mask(radius):
@@ -56,6 +62,167 @@ def gen_rounded_rectangle_mask(size, raduis):
     return mask
 
 
+@functools.lru_cache(maxsize=64)
+def gen_rounded_corner_mask(radius: int, scale: int = 5):
+    """
+    左上角四分之一圆的抗锯齿蒙版, 只对 radius x radius 的小块做超采样.
+    结果按 (radius, scale) 缓存, 调用方不要修改返回的图像
+    """
+    big_radius = radius * scale
+    corner = Image.new('L', (big_radius, big_radius), 0)
+    ImageDraw.Draw(corner).ellipse((0, 0, big_radius * 2, big_radius * 2), fill=255)
+    return corner.resize((radius, radius), Image.Resampling.BICUBIC)
+
+
+_mask_cache = LRUCache(maxcost=32 * 1024 * 1024, cost=lambda mask: mask.width * mask.height)
+
+
+def rounded_rectangle_mask(size: tuple[int, int], radius: int) -> Image.Image:
+    """
+    直接按目标尺寸生成抗锯齿的圆角矩形蒙版: 四个角贴同一块圆角, 其余部分填满.
+    结果按 (size, radius) 缓存, 调用方不要修改返回的图像.
+    """
+    size = tuple(size)
+    return _mask_cache.get_or_create((size, radius), lambda: _rounded_rectangle_mask(size, radius))
+
+
+def _rounded_rectangle_mask(size: tuple[int, int], radius: int):
+    return rounded_rectangle_band(size, radius, 0, size[1])
+
+
+def rounded_rectangle_band(size: tuple[int, int], radius: int, top: int, height: int) -> Image.Image:
+    """
+    圆角矩形蒙版中从 top 开始的 height 行, 与 rounded_rectangle_mask(size, radius) 的对应部分完全一致.
+    只有碰到上下两端的段需要贴圆角
+    """
+    width, full_height = size
+    radius = min(radius, width // 2, full_height // 2)
+    mask = Image.new('L', (width, height), 255)
+    if radius > 0 and (top < radius or top + height > full_height - radius):
+        corner = gen_rounded_corner_mask(radius)
+        bottom = full_height - radius - top
+        mask.paste(corner, (0, -top))
+        mask.paste(corner.transpose(Image.Transpose.FLIP_LEFT_RIGHT), (width - radius, -top))
+        mask.paste(corner.transpose(Image.Transpose.FLIP_TOP_BOTTOM), (0, bottom))
+        mask.paste(corner.transpose(Image.Transpose.ROTATE_180), (width - radius, bottom))
+    return mask
+
+
+QR_STYLES = ('rounded', 'square')
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+
+
+def gen_qr_module_sprite(box_size: int, rounded: bool = True):
+    """
+    单个模块的精灵图 (L 模式, 255 为前景). rounded 时四个角都是圆角, 与 qrcode 的 RoundedModuleDrawer 画法一致
+    """
+    corner_width = box_size // 2
+    sprite = Image.new('L', (corner_width * 2, corner_width * 2), 255)
+    if rounded:
+        # 4x 超采样后缩小, 与 RoundedModuleDrawer.setup_corners 相同
+        fake_width = corner_width * 4
+        base = Image.new('L', (fake_width, fake_width), 0)
+        ImageDraw.Draw(base).ellipse((0, 0, fake_width * 2, fake_width * 2), fill=255)
+        nw = base.resize((corner_width, corner_width), Image.Resampling.LANCZOS)
+        sprite.paste(nw, (0, 0))
+        sprite.paste(nw.transpose(Image.Transpose.FLIP_LEFT_RIGHT), (corner_width, 0))
+        sprite.paste(nw.transpose(Image.Transpose.FLIP_TOP_BOTTOM), (0, corner_width))
+        sprite.paste(nw.transpose(Image.Transpose.ROTATE_180), (corner_width, corner_width))
+    return sprite
+
+
+def tile_image(tile: Image.Image, count: int):
+    """
+    把 tile 平铺成 count x count, 每次翻倍粘贴, 只需 O(log count) 次 paste
+    """
+    w, h = tile.size
+    row = Image.new(tile.mode, (w * count, h))
+    row.paste(tile, (0, 0))
+    filled = 1
+    while filled < count:
+        row.paste(row.crop((0, 0, w * filled, h)), (w * filled, 0))
+        filled *= 2
+    out = Image.new(tile.mode, (w * count, h * count))
+    out.paste(row, (0, 0))
+    filled = 1
+    while filled < count:
+        out.paste(out.crop((0, 0, w * count, h * filled)), (0, h * filled))
+        filled *= 2
+    return out
+
+
+def rasterize_qr(matrix: list[list[bool]], box_size: int = QR_BOX_SIZE, border: int = QR_BORDER,
+                 style: str = 'rounded'):
+    """
+    按 StyledPilImage + RoundedModuleDrawer 的样式栅格化二维码 (定位点为方块), 返回 L 模式的前景蒙版.
+    matrix 为不含边框的模块矩阵.
+    整张图由三张图合成: 模块铺满的方块图, 平铺的圆角模块精灵图, 以及标记哪些四分之一格需要圆角的蒙版.
+    """
+    if style not in QR_STYLES:
+        raise ValueError(f'Unknown qr style: {style!r}, expected one of {QR_STYLES}')
+    width = len(matrix)
+    count = width + border * 2
+    corner_width = box_size // 2
+
+    def active(r, c):
+        return 0 <= r < width and 0 <= c < width and matrix[r][c]
+
+    def is_eye(r, c):
+        return (r < 7 and c < 7) or (r < 7 and width - c < 8) or (width - r < 8 and c < 7)
+
+    # 每个模块拆成 2x2 个四分之一格
+    cells = bytearray(count * 2 * count * 2)
+    rounded = bytearray(len(cells))
+    stride = count * 2
+    for r in range(width):
+        row = matrix[r]
+        for c in range(width):
+            if not row[c]:
+                continue
+            i = (r + border) * 2 * stride + (c + border) * 2
+            cells[i] = cells[i + 1] = cells[i + stride] = cells[i + stride + 1] = 255
+            if style != 'rounded' or is_eye(r, c):
+                continue
+            n, s, w, e = active(r - 1, c), active(r + 1, c), active(r, c - 1), active(r, c + 1)
+            rounded[i] = 255 if not (n or w) else 0
+            rounded[i + 1] = 255 if not (n or e) else 0
+            rounded[i + stride] = 255 if not (s or w) else 0
+            rounded[i + stride + 1] = 255 if not (s or e) else 0
+
+    size = (stride * corner_width,) * 2
+    squares = Image.frombytes('L', (stride, stride), bytes(cells)).resize(size, Image.Resampling.NEAREST)
+    if style == 'square' or not any(rounded):
+        return squares
+    rounded_mask = Image.frombytes('L', (stride, stride), bytes(rounded)).resize(size, Image.Resampling.NEAREST)
+    sprites = tile_image(gen_qr_module_sprite(box_size), count)
+    return Image.composite(sprites, squares, rounded_mask)
+
+
+_qr_cache = LRUCache(maxcost=16 * 1024 * 1024, cost=lambda tile: tile.width * tile.height * len(tile.getbands()))
+
+
+def qr_tile(data: str, size: int, style: str = 'rounded') -> Image.Image:
+    """
+    生成 size x size 的黑白二维码 (RGB), 按 (data, size, style) 缓存, 调用方不要修改返回的图像.
+    """
+    return _qr_cache.get_or_create((data, size, style), lambda: _qr_tile(data, size, style))
+
+
+def _qr_tile(data: str, size: int, style: str):
+    # qrcode 只在需要画二维码时导入
+    import qrcode
+
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, border=0)
+    # 如果想扫描二维码后跳转到网页，需要添加https://
+    qr.add_data(data)
+    qr.make(fit=True)
+    mask = rasterize_qr(qr.modules, style=style)
+    tile = Image.new('RGB', mask.size, (255, 255, 255))
+    tile.paste((0, 0, 0), (0, 0), mask)
+    return tile.resize((size, size))
+
+
 class Zoomer:
     def __init__(self, base_ratio: float):
         self.base_ratio = base_ratio
@@ -70,89 +237,359 @@ class Zoomer:
         return self.zoom(size)
 
 
-def quote(user_name: str, user_avatar: Image, context: str, _time: datetime, user_id: str = "",
-          medias: list[Image] = None, source: str = ""):
-    medias = medias or []
-    zoomer = Zoomer(0.5)
-    font_zoomer = Zoomer(zoomer(90))
-    if True:  # The define of fonts. Fold it pls.
-        import anyquote
-        assets_path = Path(anyquote.__file__).parent / "assets"
-        fonts_context = [
-            Font(Path(assets_path / 'SourceHanSansSC/OTF/SimplifiedChinese/SourceHanSansSC-Regular.otf'),
-                 size=font_zoomer(1)),
-            Font(Path(assets_path / 'NotoEmoji-VariableFont_wght.ttf'),
-                 size=font_zoomer(1),
-                 offset=(0, font_zoomer(8)))
-        ]
-        fonts_name = [
-            Font(
-                Path(assets_path / 'SourceHanSansSC/OTF/SimplifiedChinese/SourceHanSansSC-Bold.otf'),
-                size=font_zoomer(1.2)
-            ),
-            Font(
-                Path(assets_path / 'NotoEmoji-VariableFont_wght.ttf'),
-                size=font_zoomer(1.2),
-                offset=(0, font_zoomer(8 * 1.2))
-            )
-        ]
-        fonts_id = [
-            Font(
-                Path(assets_path / 'SourceHanSansSC/OTF/SimplifiedChinese/SourceHanSansSC-Light.otf'),
-                size=font_zoomer(0.64)
-            ),
-        ]
+DEFAULT_SCALE = 0.5
+# quote() 的排版以 2000px 宽为基准, scale 为相对它的缩放比例
+BASE_WIDTH = 2000
+# quote_bands 每次渲染的行数, 1000px 宽时每段 RGBA 约 4MB
+BAND_HEIGHT = 1024
+
+
+def resolve_scale(scale: float = None, width: int = None) -> float:
+    if scale is not None and width is not None:
+        raise ValueError('Pass either scale or width, not both')
+    if width is not None:
+        return width / BASE_WIDTH
+    return DEFAULT_SCALE if scale is None else scale
+
+
+def avatar_size(scale: float = None, width: int = None) -> int:
+    """
+    该缩放比例下头像的像素边长, 用于按输出尺寸下载头像
+    """
+    return Zoomer(resolve_scale(scale, width))(300)
+
+
+def font_specs(font_zoomer: Zoomer):
+    """
+    quote() 使用的字体定义, 每项为 (path, size, offset)
+    """
+    import anyquote
+    assets_path = Path(anyquote.__file__).parent / "assets"
+
+    def emoji_offset(size):
+        # emoji 下移 8px (以 45px 字号为准), 随字号缩放. Font 会把 offset 除以 size
+        return 0, size * font_zoomer.base_ratio * 8 / 45
+
+    fonts_context = [
+        (Path(assets_path / 'SourceHanSansSC/OTF/SimplifiedChinese/SourceHanSansSC-Regular.otf'), font_zoomer(1)),
+        (Path(assets_path / 'NotoEmoji-VariableFont_wght.ttf'), font_zoomer(1), emoji_offset(font_zoomer(1)))
+    ]
+    fonts_name = [
+        (Path(assets_path / 'SourceHanSansSC/OTF/SimplifiedChinese/SourceHanSansSC-Bold.otf'), font_zoomer(1.2)),
+        (Path(assets_path / 'NotoEmoji-VariableFont_wght.ttf'), font_zoomer(1.2), emoji_offset(font_zoomer(1.2)))
+    ]
+    fonts_id = [
+        (Path(assets_path / 'SourceHanSansSC/OTF/SimplifiedChinese/SourceHanSansSC-Light.otf'), font_zoomer(0.64)),
+    ]
+    return fonts_context, fonts_name, fonts_id
+
+
+def load_fonts(font_zoomer: Zoomer):
+    return tuple(FontChain.of(font_registry.get(*spec) for spec in specs) for specs in font_specs(font_zoomer))
 
-    # To calculate the high of context
 
-    context_textbox = TextBox(
+def warm_up(*scales: float):
+    """
+    预加载 quote() 在这些缩放比例 (默认 DEFAULT_SCALE) 下需要的全部字体, 之后的渲染不再读取字体文件
+    """
+    for scale in scales or (DEFAULT_SCALE,):
+        for specs in font_specs(Zoomer(Zoomer(scale)(90))):
+            font_registry.warm_up(specs)
+
+
+def context_layout(context: str, fonts_context: FontChain, zoomer: Zoomer, font_zoomer: Zoomer) -> TextLayout:
+    return TextBox(
         text=context,
         fonts=fonts_context,
         max_width=zoomer(1800),
         line_spacing=font_zoomer(1 / 3),
         spacing=font_zoomer(1 / 6),
         symbol_push=True
-    )
+    ).layout
 
-    # Init image
 
-    img = Image.new('RGB', (zoomer(2000), int(context_textbox.high) + zoomer(900)), (255, 255, 255))
-    # img.paste(user_avatar.resize((300, 300)), (100, 100), mask=gen_rounded_mask(5000).resize((300, 300)))
+def _prepare(context: str, scale: float, layout: TextLayout = None):
+    """
+    返回 (zoomer, font_zoomer, 字体, 正文排版, 画布尺寸), 字体为 (fonts_context, fonts_name, fonts_id)
+    """
+    zoomer = Zoomer(scale)
+    font_zoomer = Zoomer(zoomer(90))
+    fonts = load_fonts(font_zoomer)
+
+    # To calculate the high of context
+
+    if layout is None:
+        layout = context_layout(context, fonts[0], zoomer, font_zoomer)
+    return zoomer, font_zoomer, fonts, layout, (zoomer(BASE_WIDTH), int(layout.height) + zoomer(900))
+
 
-    img.paste(user_avatar.resize((zoomer(300), zoomer(300))), (zoomer(100), zoomer(100)),
-              mask=gen_rounded_rectangle_mask((5000, 5000), 1000).resize((zoomer(300), zoomer(300))))
+def _draw(img: Image.Image, top: int, user_name: str, user_avatar: Image, _time: datetime, user_id: str,
+          source: str, zoomer: Zoomer, font_zoomer: Zoomer, fonts: tuple[FontChain, ...], layout: TextLayout):
+    """
+    在 img 上绘制整张 quote 中从第 top 行开始的部分, 整张绘制时 top 为 0
+    """
+    _, fonts_name, fonts_id = fonts
     draw = ImageDraw.Draw(img)
+    bottom = top + img.height
 
-    user_info_x = zoomer(460)  # Base x of user info
+    # the header ends above the context, the footer starts below it
+    if top < zoomer(500):
+        # img.paste(user_avatar.resize((300, 300)), (100, 100), mask=gen_rounded_mask(5000).resize((300, 300)))
+        img.paste(user_avatar.resize((zoomer(300), zoomer(300))), (zoomer(100), zoomer(100) - top),
+                  mask=rounded_rectangle_mask((zoomer(300), zoomer(300)), zoomer(60)))
 
-    # Draw username
+        user_info_x = zoomer(460)  # Base x of user info
 
-    Text(text=user_name, fonts=fonts_name).draw(draw, (user_info_x, zoomer(135)), (0, 0, 0))
-    # Draw user id
+        # Draw username
 
-    Text(f'@{user_id}', fonts_id).draw(draw, (user_info_x, zoomer(135) + font_zoomer(1.5)), (128, 128, 128))
+        Text(text=user_name, fonts=fonts_name).draw(draw, (user_info_x, zoomer(135) - top), (0, 0, 0))
+        # Draw user id
+
+        Text(f'@{user_id}', fonts_id).draw(draw, (user_info_x, zoomer(135) + font_zoomer(1.5) - top),
+                                           (128, 128, 128))
 
     # Draw context
 
-    context_textbox.draw(draw, zoomer(100), zoomer(500))
-    Text(_time.strftime("%I:%M %p · %b %d, %y"), fonts_id).draw(draw, (zoomer(100), context_textbox.high + zoomer(700)),
-                                                                (128, 128, 128))
+    layout.draw(draw, zoomer(100), zoomer(500) - top, (0, 0, 0), rows=(0, img.height))
+    if bottom > layout.height + zoomer(500):
+        Text(_time.strftime("%I:%M %p · %b %d, %y"), fonts_id).draw(
+            draw, (zoomer(100), layout.height + zoomer(700) - top), (128, 128, 128))
 
-    if source:
-        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L)
-        # 如果想扫描二维码后跳转到网页，需要添加https://
-        qr.add_data(source)
-        qrc = qr.make_image(image_factory=StyledPilImage, module_drawer=RoundedModuleDrawer())
-        img.paste(qrc.resize((zoomer(300), zoomer(300))), (zoomer(1600), int(context_textbox.high) + zoomer(550)))
+        if source:
+            img.paste(qr_tile(source, zoomer(300)), (zoomer(1600), int(layout.height) + zoomer(550) - top))
 
-    img_rt = Image.new('RGBA', img.size, (255, 255, 255, 0))
-    x, y = img.size
-    img_rt.paste(img, (0, 0), mask=gen_rounded_rectangle_mask((x * 5, y * 5), zoomer(300)).resize((x, y)))
 
-    return img_rt
+def _render(user_name: str, user_avatar: Image, context: str, _time: datetime, user_id: str = "",
+            medias: list[Image] = None, source: str = "", *, scale: float = DEFAULT_SCALE,
+            layout: TextLayout = None):
+    """
+    渲染不带圆角透明的 RGB 画布, 返回 (画布, 圆角半径). layout 为已经排好的正文, 传入时不再重新排版
+    """
+    medias = medias or []
+    zoomer, font_zoomer, fonts, layout, size = _prepare(context, scale, layout)
 
+    # Init image
+
+    img = Image.new('RGB', size, (255, 255, 255))
+    _draw(img, 0, user_name, user_avatar, _time, user_id, source, zoomer, font_zoomer, fonts, layout)
+    return img, zoomer(60)
+
+
+def quote_bands(user_name: str, user_avatar: Image, context: str, _time: datetime, user_id: str = "",
+                medias: list[Image] = None, source: str = "", *, scale: float = None, width: int = None,
+                band_height: int = BAND_HEIGHT) -> tuple[tuple[int, int], Iterator[Image.Image]]:
+    """
+    分段渲染很长的 quote, 返回 (整张图的尺寸, 逐段生成 RGBA 图像的迭代器). 每段最多 band_height 行,
+    同一时刻只有一段画布在内存中, 所以内存占用与正文长度无关. 各段从上到下拼起来与 quote() 的结果完全一致
+    """
+    if band_height < 1:
+        raise ValueError(f'band_height must be positive, got {band_height}')
+    zoomer, font_zoomer, fonts, layout, size = _prepare(context, resolve_scale(scale, width))
+    radius = zoomer(60)
+
+    def bands():
+        for top in range(0, size[1], band_height):
+            band = Image.new('RGB', (size[0], min(band_height, size[1] - top)), (255, 255, 255))
+            _draw(band, top, user_name, user_avatar, _time, user_id, source, zoomer, font_zoomer, fonts, layout)
+            band.putalpha(rounded_rectangle_band(size, radius, top, band.height))
+            yield band
 
-def quote_twitter(url: str, *, driver: webdriver.Chrome = None):
-    user_name, user_id, user_avatar, context, medias, t = get_tweet_info(url, driver=driver)
+    return size, bands()
+
+
+def quote(user_name: str, user_avatar: Image, context: str, _time: datetime, user_id: str = "",
+          medias: list[Image] = None, source: str = "", *, scale: float = None, width: int = None):
+    """
+    scale 为相对 2000px 基准的缩放比例 (默认 0.5, 即 1000px 宽), 也可以直接给出输出宽度 width
+    """
+    img, radius = _render(user_name, user_avatar, context, _time, user_id, medias, source,
+                          scale=resolve_scale(scale, width))
+    # 画布四角本来就是白色, 直接把圆角蒙版作为 alpha 通道, 不必再复制一张 RGBA 图
+    img.putalpha(rounded_rectangle_mask(img.size, radius))
+    return img
+
+
+def quote_sizes(user_name: str, user_avatar: Image, context: str, _time: datetime, user_id: str = "",
+                medias: list[Image] = None, source: str = "", *, widths: Sequence[int]) -> list[Image.Image]:
+    """
+    一次生成多个宽度的 quote. 正文只在最大的宽度下排版一次, 其余尺寸缩放这份排版结果, 换行位置完全一致
+    """
+    scales = [resolve_scale(width=width) for width in widths]
+    reference = max(scales)
+    zoomer = Zoomer(reference)
+    font_zoomer = Zoomer(zoomer(90))
+    layout = context_layout(context, load_fonts(font_zoomer)[0], zoomer, font_zoomer)
+    images = []
+    for scale in scales:
+        fonts_context = load_fonts(Zoomer(Zoomer(scale)(90)))[0]
+        img, radius = _render(user_name, user_avatar, context, _time, user_id, medias, source, scale=scale,
+                              layout=layout if scale == reference else layout.scaled(scale / reference,
+                                                                                     fonts_context))
+        img.putalpha(rounded_rectangle_mask(img.size, radius))
+        images.append(img)
+    return images
+
+
+OUTPUT_FORMATS = {'png': 'PNG', 'webp': 'WEBP', 'jpeg': 'JPEG', 'jpg': 'JPEG'}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# compressed bytes collected before an IDAT chunk is written
+PNG_IDAT_SIZE = 1 << 16
+
+
+@dataclass
+class EncodeResult:
+    format: str
+    size: tuple[int, int]
+    bytes: int
+    render_time: float
+    encode_time: float
+
+
+class _CountingWriter:
+    """
+    统计写入字节数, 其余操作交给被包装的文件对象
+    """
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fp.write(data)
+
+    def flush(self):
+        if hasattr(self.fp, 'flush'):
+            self.fp.flush()
+
+
+class PngStreamWriter:
+    """
+    按行分段写入 RGBA PNG, 只缓存压缩后还没写出的数据. 每行都不做预测滤波,
+    对白底文字的画布这样压缩得比 Pillow 的自适应滤波更小也更快.
+    """
+
+    def __init__(self, fp: BinaryIO, size: tuple[int, int], *, compress_level: int = 3):
+        self.size = size
+        self.rows = 0
+        self._writer = _CountingWriter(fp)
+        self._compressor = zlib.compressobj(compress_level)
+        self._idat = bytearray()
+        self._writer.write(PNG_SIGNATURE)
+        # 8-bit RGBA, deflate, no interlace
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, 6, 0, 0, 0))
+
+    def _chunk(self, tag: bytes, data: bytes):
+        self._writer.write(struct.pack('>I', len(data)) + tag)
+        self._writer.write(data)
+        self._writer.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+    def _add(self, data: bytes):
+        self._idat += data
+        if len(self._idat) >= PNG_IDAT_SIZE:
+            self._chunk(b'IDAT', self._idat)
+            self._idat = bytearray()
+
+    def write(self, band: Image.Image):
+        if band.mode != 'RGBA' or band.width != self.size[0]:
+            raise ValueError(f'Expected an RGBA band {self.size[0]} pixels wide, got {band.mode} {band.size}')
+        if self.rows + band.height > self.size[1]:
+            raise ValueError(f'Too many rows: {self.rows + band.height} > {self.size[1]}')
+        data = memoryview(band.tobytes())
+        stride = 4 * band.width
+        # every row starts with its filter type, 0 for none
+        self._add(self._compressor.compress(
+            b''.join(part for start in range(0, len(data), stride) for part in (b'\0', data[start:start + stride]))))
+        self.rows += band.height
+
+    def close(self) -> int:
+        """
+        写出剩余数据和文件尾, 返回写入的总字节数
+        """
+        if self.rows != self.size[1]:
+            raise ValueError(f'Expected {self.size[1]} rows, got {self.rows}')
+        self._idat += self._compressor.flush()
+        self._chunk(b'IDAT', self._idat)
+        self._idat = bytearray()
+        self._chunk(b'IEND', b'')
+        return self._writer.count
+
+
+def encode_canvas(img: Image.Image, radius: int, fp: BinaryIO, format: str = 'png', *, compress_level: int = 3,
+                  lossless: bool = True, quality: int = None, method: int = 4,
+                  background: tuple[int, int, int] = (255, 255, 255)) -> int:
+    """
+    把 _render() 得到的画布按 format 编码写入 fp, 返回写入的字节数.
+    png / webp 带圆角透明; jpeg 不需要 alpha, 圆角外填充 background.
+    """
+    fmt = OUTPUT_FORMATS.get(format.lower())
+    if fmt is None:
+        raise ValueError(f'Unknown output format: {format!r}, expected one of {tuple(OUTPUT_FORMATS)}')
+    writer = _CountingWriter(fp)
+    if fmt == 'JPEG':
+        # 画布四角本来就是白色, 只有背景色不同时才需要蒙版
+        if tuple(background) != (255, 255, 255):
+            img.paste(tuple(background), (0, 0), rounded_rectangle_mask(img.size, radius).point(lambda v: 255 - v))
+        img.save(writer, 'JPEG', quality=90 if quality is None else quality)
+    else:
+        img.putalpha(rounded_rectangle_mask(img.size, radius))
+        if fmt == 'PNG':
+            img.save(writer, 'PNG', compress_level=compress_level)
+        else:
+            if quality is None:
+                quality = 80 if lossless else 85
+            img.save(writer, 'WEBP', lossless=lossless, quality=quality, method=method)
+    return writer.count
+
+
+def quote_to(fp: str | PathLike | BinaryIO, user_name: str, user_avatar: Image, context: str, _time: datetime,
+             user_id: str = "", medias: list[Image] = None, source: str = "", *, format: str = 'png',
+             scale: float = None, width: int = None, band_height: int = None, **options) -> EncodeResult:
+    """
+    渲染并直接编码到 fp (文件路径或可写的二进制文件对象). options 参见 encode_canvas.
+    给出 band_height 时按段渲染并流式写入 PNG (只支持 png), 内存占用与正文长度无关, 见 quote_bands.
+    返回输出格式, 尺寸, 字节数, 以及渲染和编码各自的耗时
+    """
+    if isinstance(fp, (str, PathLike)):
+        with open(fp, 'wb') as f:
+            return quote_to(f, user_name, user_avatar, context, _time, user_id, medias, source, format=format,
+                            scale=scale, width=width, band_height=band_height, **options)
+    if band_height is not None:
+        if OUTPUT_FORMATS.get(format.lower()) != 'PNG':
+            raise ValueError(f'Banded output only supports png, got {format!r}')
+        return _quote_to_bands(fp, user_name, user_avatar, context, _time, user_id, medias, source, scale=scale,
+                               width=width, band_height=band_height, **options)
+    start = time.perf_counter()
+    img, radius = _render(user_name, user_avatar, context, _time, user_id, medias, source,
+                          scale=resolve_scale(scale, width))
+    rendered = time.perf_counter()
+    size = encode_canvas(img, radius, fp, format, **options)
+    return EncodeResult(OUTPUT_FORMATS[format.lower()], img.size, size, rendered - start,
+                        time.perf_counter() - rendered)
+
+
+def _quote_to_bands(fp: BinaryIO, *args, scale: float, width: int, band_height: int,
+                    compress_level: int = 3) -> EncodeResult:
+    render_time = encode_time = 0.0
+    start = time.perf_counter()
+    size, bands = quote_bands(*args, scale=scale, width=width, band_height=band_height)
+    writer = PngStreamWriter(fp, size, compress_level=compress_level)
+    for band in bands:
+        rendered = time.perf_counter()
+        render_time += rendered - start
+        writer.write(band)
+        start = time.perf_counter()
+        encode_time += start - rendered
+    written = writer.close()
+    return EncodeResult('PNG', size, written, render_time, encode_time + time.perf_counter() - start)
+
+
+def quote_twitter(url: str, *, driver: 'webdriver.Chrome' = None, scale: float = None, width: int = None):
+    # 抓取推文需要 selenium 和 twitter 客户端, 只在这里导入, 只渲染的进程不必加载它们
+    from ..internet.twi import get_tweet_info
+
+    scale = resolve_scale(scale, width)
+    user_name, user_id, user_avatar, context, medias, t = get_tweet_info(url, driver=driver,
+                                                                         avatar_size=avatar_size(scale))
     return quote(user_name=user_name, user_avatar=user_avatar, context=context, _time=t, user_id=user_id, medias=medias,
-                 source=url)
+                 source=url, scale=scale)
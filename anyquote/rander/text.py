@@ -23,145 +23,934 @@
 
 @Date       : 2024/8/2 下午7:26
 """
+import codecs
+import functools
+import hashlib
+import itertools
 import math
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from dataclasses import dataclass, field
 from os import PathLike
+from pathlib import Path
+from typing import Iterable, Sequence
 
-from PIL import ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont
 from fontTools.ttLib import TTFont
 
+from ..cache import LRUCache, cache_dir
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BMP_SIZE = 0x10000
+# below this length a plain loop is faster than building NumPy arrays
+NUMPY_MIN_LENGTH = 64
+# glyphs kept by the measurement cache, see measure
+MEASURE_CACHE_GLYPHS = int(os.environ.get('ANYQUOTE_MEASURE_CACHE_GLYPHS', 32768))
+# shorter segments are cheaper to measure in place than to look up, see Line.get_length
+MEASURE_MIN_LENGTH = 6
+
+
+# character classes, one bit each, see classify
+HALFWIDTH = 1
+CHINESE = 2
+ALPHA = 4
+FULL_WIDTH_SYMBOL = 8  # Line.full_width_symbols, squeezed by justify and symbol_push
+LINE_START_HALF = 16  # opening brackets, half width at the start of a line
+LINE_END_HALF = 32  # closing brackets, half width at the end of a line
+CLOSING_PUNCT = 64  # half width when followed by OPENING_PUNCT
+OPENING_PUNCT = 128
+
+FULL_WIDTH_SYMBOLS = '，。、；：？！\'":《（【“”』'
+
+
+def _build_char_classes() -> bytearray:
+    table = bytearray(BMP_SIZE)
+
+    def mark(chars: Iterable[int], flag: int):
+        for cp in chars:
+            table[cp] |= flag
+
+    mark(range(0x80), HALFWIDTH)
+    mark(itertools.chain(range(0x3400, 0x4dc0), range(0x4e00, 0x9fb0)), CHINESE)
+    mark(itertools.chain(range(0x30, 0x3a), range(0x41, 0x5b), range(0x61, 0x7b)), ALPHA)
+    mark(map(ord, FULL_WIDTH_SYMBOLS), FULL_WIDTH_SYMBOL)
+    mark(map(ord, '《（【〔“'), LINE_START_HALF)
+    mark(map(ord, '》）】〕”、。'), LINE_END_HALF)
+    mark(map(ord, '》）】，。、；：？！”'), CLOSING_PUNCT)
+    mark(map(ord, '《（【，。、“'), OPENING_PUNCT)
+    return table
+
+
+# class bits of every BMP code point, characters outside the BMP have no class
+CHAR_CLASSES = bytes(_build_char_classes())
+# the same table as a str, so that str.translate can map a whole string at C speed
+_CLASS_TABLE = CHAR_CLASSES.decode('latin-1')
+# str.translate leaves characters outside the table untouched, encode then turns them into 0
+codecs.register_error('anyquote.no_class', lambda e: ('\x00' * (e.end - e.start), e.end))
+
+
+def char_class(char: str) -> int:
+    cp = ord(char)
+    return CHAR_CLASSES[cp] if cp < BMP_SIZE else 0
+
+
+def classify(text: str) -> bytes:
+    """
+    一次算出整个字符串每个字符的类别, classify(text)[i] == char_class(text[i])
+    """
+    return text.translate(_CLASS_TABLE).encode('latin-1', 'anyquote.no_class')
+
+
+@functools.cache
+def _flag_mask(flag: int) -> bytes:
+    return bytes(c & flag for c in range(256))
+
+
+def count_class(classes: bytes, flag: int) -> int:
+    """
+    classes 中带有 flag 的字符个数
+    """
+    return len(classes) - classes.translate(_flag_mask(flag)).count(0)
+
 
 def is_halfwidth(char):
     """
     判断一个字符是否是半角
     """
-    if len(char) != len(char.encode()):
-        return False
-    else:
-        return True
+    return char_class(char) & HALFWIDTH != 0
 
 
 def is_chinese(char: str):
-    return 0x3400 <= ord(char) <= 0x4dbf or 0x4e00 <= ord(char) <= 0x9faf
+    return char_class(char) & CHINESE != 0
 
 
 def is_alpha(char: str):
-    return 0x0030 <= ord(char) <= 0x0039 or 0x0041 <= ord(char) <= 0x005a or 0x0061 <= ord(char) <= 0x007a
+    return char_class(char) & ALPHA != 0
+
+
+# the (platform, encoding) order of TTFont.getBestCmap
+CMAP_PREFERENCES = ((3, 10), (0, 6), (0, 4), (3, 1), (0, 3), (0, 2), (0, 1), (0, 0))
+
+
+def _big_endian_array(typecode: str, data: bytes) -> array:
+    values = array(typecode, data)
+    if sys.byteorder != 'big':
+        values.byteswap()
+    return values
+
+
+def _read_advances(data: bytes, count: int, num_glyphs: int) -> array:
+    """
+    hmtx/vmtx 中每个字形的 advance: 前 count 个字形为 (advance, side bearing), 之后的字形沿用最后一个 advance
+    """
+    advances = _big_endian_array('H', data[:4 * count])[::2]
+    advances.extend(itertools.repeat(advances[-1], num_glyphs - count))
+    return advances
+
+
+def _read_cmap_format_12(ttf: TTFont) -> dict[int, int] | None:
+    """
+    getBestCmap 会选中的子表为 format 12 时, 读出 codepoint -> glyph id, 规则与 fontTools 一致. 否则返回 None
+    """
+    data = ttf.reader['cmap']
+    _, count = struct.unpack_from('>HH', data)
+    offsets = {}
+    for i in range(count):
+        platform_id, encoding_id, offset = struct.unpack_from('>HHI', data, 4 + 8 * i)
+        offsets.setdefault((platform_id, encoding_id), offset)
+    offset = next((offsets[key] for key in CMAP_PREFERENCES if key in offsets), None)
+    if offset is None or struct.unpack_from('>H', data, offset)[0] != 12:
+        return None
+    n_groups = struct.unpack_from('>I', data, offset + 12)[0]
+    groups = _big_endian_array('I', data[offset + 16:offset + 16 + 12 * n_groups])
+    cmap = {}
+    last_end = 0
+    for start, end, glyph_id in zip(*[iter(groups)] * 3):
+        end = min(end, 0x10ffff)
+        # inverted and overlapping groups are skipped, like fontTools and HarfBuzz do
+        if start > end or start < last_end:
+            continue
+        last_end = end
+        if glyph_id == 0:
+            # the missing glyph maps only the first code point of a group
+            start += 1
+            glyph_id += 1
+        cmap.update(zip(range(start, end + 1), range(glyph_id, glyph_id + end - start + 1)))
+    return cmap
+
+
+@dataclass(frozen=True, slots=True)
+class FontMetrics:
+    """
+    排版用到的字体度量, 与字号无关. 从 TTFont 中提取一次后就不再需要 fontTools 的对象
+    """
+    units_per_em: int
+    # BMP codepoint -> advance width in font units, only meaningful where covered is 1.
+    # memoryviews into the mmapped file when loaded by font_metrics
+    advances: array | memoryview
+    covered: bytes | memoryview
+    # codepoint -> advance width for characters outside the BMP
+    astral: dict[int, int]
+    # vertical advances in the same layout, None when the font has no vmtx table
+    vertical_advances: array | memoryview | None
+    astral_vertical: dict[int, int] | None
+    # Pillow's basic layout applies the legacy kern table between glyphs of one draw.text call
+    kerning: bool
+
+    @classmethod
+    def from_ttf(cls, ttf: TTFont) -> 'FontMetrics':
+        glyph_ids = ttf.getReverseGlyphMap()
+        glyph_order = ttf.getGlyphOrder()
+        hmtx = ttf['hmtx'].metrics
+        vmtx = ttf['vmtx'].metrics if 'vmtx' in ttf else None
+        return cls._build(ttf['head'].unitsPerEm,
+                          {codepoint: glyph_ids[name] for codepoint, name in ttf.getBestCmap().items()},
+                          array('H', (hmtx[name][0] for name in glyph_order)),
+                          None if vmtx is None else array('H', (vmtx[name][0] for name in glyph_order)),
+                          'kern' in ttf)
+
+    @classmethod
+    def load(cls, font: str | PathLike) -> 'FontMetrics':
+        """
+        直接从原始的 cmap, hmtx 和 vmtx 表读取, 不需要字形名, 也就不会解析 CFF. cmap 不是 format 12 时退回 from_ttf
+        """
+        with TTFont(font) as ttf:
+            cmap = _read_cmap_format_12(ttf)
+            if cmap is None:
+                return cls.from_ttf(ttf)
+            num_glyphs = ttf['maxp'].numGlyphs
+            return cls._build(ttf['head'].unitsPerEm, cmap,
+                              _read_advances(ttf.reader['hmtx'], ttf['hhea'].numberOfHMetrics, num_glyphs),
+                              _read_advances(ttf.reader['vmtx'], ttf['vhea'].numberOfVMetrics, num_glyphs)
+                              if 'vmtx' in ttf else None,
+                              'kern' in ttf)
+
+    @classmethod
+    def _build(cls, units_per_em: int, cmap: dict[int, int], glyph_advances: array, glyph_vertical: array | None,
+               kerning: bool) -> 'FontMetrics':
+        advances = array('H', bytes(2 * BMP_SIZE))
+        vertical = None if glyph_vertical is None else array('H', bytes(2 * BMP_SIZE))
+        covered = bytearray(BMP_SIZE)
+        astral = {}
+        astral_vertical = None if glyph_vertical is None else {}
+        for codepoint, glyph_id in cmap.items():
+            if glyph_id >= len(glyph_advances):
+                continue
+            if codepoint < BMP_SIZE:
+                covered[codepoint] = 1
+                advances[codepoint] = glyph_advances[glyph_id]
+                if vertical is not None:
+                    vertical[codepoint] = glyph_vertical[glyph_id]
+            else:
+                astral[codepoint] = glyph_advances[glyph_id]
+                if astral_vertical is not None:
+                    astral_vertical[codepoint] = glyph_vertical[glyph_id]
+        return cls(units_per_em=units_per_em, advances=advances, covered=bytes(covered), astral=astral,
+                   vertical_advances=vertical, astral_vertical=astral_vertical, kerning=kerning)
+
+    def codepoints(self) -> Iterable[int]:
+        """
+        字体覆盖的全部 codepoint
+        """
+        return itertools.chain(itertools.compress(range(BMP_SIZE), self.covered), self.astral)
+
+    def advance(self, codepoint: int) -> int | None:
+        if codepoint < BMP_SIZE:
+            return self.advances[codepoint] if self.covered[codepoint] else None
+        return self.astral.get(codepoint)
+
+
+# 字体度量的磁盘缓存. 文件由 font_metrics 生成, 各进程只读 mmap 同一个文件, 共享它的内存页.
+# 文件格式: 64 字节的头, 然后依次为 covered, advances, vertical_advances (如果有), 以及 astral 的 codepoint,
+# advance 和 vertical advance. 数组按本机字节序存储. 格式改变时增加版本号, 旧文件会被重新生成
+METRICS_CACHE_VERSION = 1
+_METRICS_MAGIC = b'AQFM'
+# magic, version, little endian, kerning, unitsPerEm, has vertical, astral count,
+# font file size, font file mtime_ns, font file sha256
+_METRICS_HEADER = struct.Struct('<4sH??H?Iqq32s')
+_METRICS_HEADER_SIZE = 64
+
+
+def metrics_cache_path(font: str | PathLike) -> Path:
+    """
+    字体文件对应的度量缓存文件, 位于 cache_dir('fonts') 下
+    """
+    real = os.path.realpath(font)
+    return cache_dir('fonts', f'{Path(real).stem}-{hashlib.sha256(os.fsencode(real)).hexdigest()[:16]}.metrics')
+
+
+def _font_digest(font: str | PathLike) -> bytes:
+    with open(font, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').digest()
+
+
+def _write_metrics_cache(path: Path, metrics: FontMetrics, stat: os.stat_result, digest: bytes):
+    vertical = metrics.vertical_advances is not None
+    header = _METRICS_HEADER.pack(_METRICS_MAGIC, METRICS_CACHE_VERSION, sys.byteorder == 'little', metrics.kerning,
+                                  metrics.units_per_em, vertical, len(metrics.astral), stat.st_size,
+                                  stat.st_mtime_ns, digest)
+    sections = [header.ljust(_METRICS_HEADER_SIZE, b'\0'), metrics.covered, metrics.advances]
+    if vertical:
+        sections.append(metrics.vertical_advances)
+    sections += [array('I', metrics.astral), array('H', metrics.astral.values())]
+    if vertical:
+        sections.append(array('H', (metrics.astral_vertical[codepoint] for codepoint in metrics.astral)))
+    tmp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.writelines(sections)
+        # readers that already mapped the old file keep their pages
+        os.replace(tmp, path)
+    except OSError:
+        # 磁盘缓存只是加速, 写失败时忽略
+        tmp.unlink(missing_ok=True)
+
+
+def _read_metrics_cache(path: Path) -> tuple[FontMetrics, tuple[int, int], bytes] | None:
+    """
+    mmap 缓存文件, 返回 (度量, 生成时字体文件的 (size, mtime_ns), 字体文件的 sha256). 文件不存在或不可用时返回 None
+    """
+    try:
+        with open(path, 'rb') as f:
+            buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+    if len(buffer) < _METRICS_HEADER_SIZE:
+        return None
+    (magic, version, little_endian, kerning, units_per_em, vertical, astral_count, size, mtime_ns,
+     digest) = _METRICS_HEADER.unpack_from(buffer)
+    if (magic, version, little_endian) != (_METRICS_MAGIC, METRICS_CACHE_VERSION, sys.byteorder == 'little'):
+        return None
+    if len(buffer) != (_METRICS_HEADER_SIZE + BMP_SIZE * (5 if vertical else 3) +
+                       astral_count * (8 if vertical else 6)):
+        return None
+
+    offset = _METRICS_HEADER_SIZE
+
+    def take(length: int, fmt: str = 'B') -> memoryview:
+        nonlocal offset
+        view = buffer[offset:offset + length].cast(fmt)
+        offset += length
+        return view
+
+    covered = take(BMP_SIZE)
+    advances = take(2 * BMP_SIZE, 'H')
+    vertical_advances = take(2 * BMP_SIZE, 'H') if vertical else None
+    astral_codepoints = take(4 * astral_count, 'I')
+    astral = dict(zip(astral_codepoints, take(2 * astral_count, 'H')))
+    astral_vertical = dict(zip(astral_codepoints, take(2 * astral_count, 'H'))) if vertical else None
+    metrics = FontMetrics(units_per_em=units_per_em, advances=advances, covered=covered, astral=astral,
+                          vertical_advances=vertical_advances, astral_vertical=astral_vertical, kerning=kerning)
+    return metrics, (size, mtime_ns), digest
+
+
+def font_metrics(font: str | PathLike) -> FontMetrics:
+    """
+    读取字体度量, 优先使用 mmap 的磁盘缓存. 字体文件的大小和修改时间没变时直接使用缓存,
+    变了则比较文件的 sha256, 内容不同时重新解析字体并重写缓存.
+    """
+    path = metrics_cache_path(font)
+    stat = os.stat(font)
+    cached = _read_metrics_cache(path)
+    if cached is not None:
+        metrics, cached_stat, cached_digest = cached
+        if cached_stat == (stat.st_size, stat.st_mtime_ns):
+            return metrics
+        digest = _font_digest(font)
+        if digest == cached_digest:
+            # same content, e.g. the font was copied or touched: only record the new size and mtime
+            _write_metrics_cache(path, metrics, stat, digest)
+            return metrics
+    else:
+        digest = _font_digest(font)
+    metrics = FontMetrics.load(font)
+    _write_metrics_cache(path, metrics, stat, digest)
+    # map the file just written, so that this process shares its pages with the other workers too
+    cached = _read_metrics_cache(path)
+    return metrics if cached is None else cached[0]
 
 
 class Font:
-    def __init__(self, font: str | PathLike, size=20, offset: tuple[int, int] = None):
+    def __init__(self, font: str | PathLike, size=20, offset: tuple[int, int] = None, *,
+                 metrics: FontMetrics = None, ttf: TTFont = None):
         self.font = font
-        self.ttf = TTFont(font)
+        # (path, size, offset) as accepted by FontRegistry.get
+        self.spec = (os.fspath(font), size, None if offset is None else tuple(offset))
+        if metrics is None:
+            metrics = FontMetrics.from_ttf(ttf) if ttf is not None else font_metrics(font)
+        self.metrics = metrics
         self._imf = None
         self.offset = (0, 0) if offset is None else (offset[0] / size, offset[1] / size)
-        self.best_cmap = self.ttf.getBestCmap()
         self.size = size
-        self.glyphs = self.ttf.getGlyphSet()
+        self._rate = size / metrics.units_per_em
+        self._advances = None
+        self._astral_advances = None
+        self._np_advances = None
+        self._pil_lengths: dict[str, float] = {}
+        self.kerning = metrics.kerning
 
     @property
     def imf(self):
         if self._imf is None:
-            self._imf = ImageFont.truetype(self.font, self.size)
+            # runs of glyphs are positioned by our own layout, so keep Pillow from shaping them
+            self._imf = ImageFont.truetype(self.font, self.size, layout_engine=ImageFont.Layout.BASIC)
         return self._imf
 
+    def get_pil_length(self, _char: str) -> float:
+        """
+        Pillow 绘制该字符时使用的字宽
+        """
+        if (length := self._pil_lengths.get(_char)) is None:
+            length = self._pil_lengths[_char] = self.imf.getlength(_char)
+        return length
+
     def get_char_size(self, _char):
-        units_per_em = self.ttf['head'].unitsPerEm
-        rate = self.size / units_per_em
-        word_graph = self.glyphs.get(self.best_cmap[ord(_char)])
-        return word_graph.width * rate, word_graph.height * rate
+        metrics = self.metrics
+        codepoint = ord(_char)
+        width = metrics.advance(codepoint)
+        if width is None:
+            raise KeyError(codepoint)
+        if metrics.vertical_advances is None:
+            return width * self._rate, None
+        if codepoint < BMP_SIZE:
+            height = metrics.vertical_advances[codepoint]
+        else:
+            height = metrics.astral_vertical[codepoint]
+        return width * self._rate, height * self._rate
+
+    @property
+    def advances(self) -> array:
+        """
+        BMP 内 codepoint -> 缩放后的宽度, 字体中没有的字符为 nan. BMP 以外的字符在 astral_advances 中.
+        按字号展开的表, 只有批量的 measure 会用到.
+        """
+        if self._advances is None:
+            rate = self._rate
+            metrics = self.metrics
+            units = metrics.advances
+            advances = array('d', [math.nan]) * BMP_SIZE
+            for codepoint in itertools.compress(range(BMP_SIZE), metrics.covered):
+                advances[codepoint] = units[codepoint] * rate
+            self._astral_advances = {codepoint: width * rate for codepoint, width in metrics.astral.items()}
+            self._np_advances = None if np is None else np.frombuffer(advances, dtype=np.float64)
+            self._advances = advances
+        return self._advances
+
+    @property
+    def astral_advances(self) -> dict[int, float]:
+        _ = self.advances
+        return self._astral_advances
+
+    def get_char_width(self, _char: str) -> float:
+        codepoint = ord(_char)
+        metrics = self.metrics
+        if codepoint < BMP_SIZE:
+            if metrics.covered[codepoint]:
+                return metrics.advances[codepoint] * self._rate
+        elif (width := metrics.astral.get(codepoint)) is not None:
+            return width * self._rate
+        raise KeyError(codepoint)
+
+    def measure(self, text: str) -> Sequence[float]:
+        """
+        一次性查出字符串中每个字符的宽度 (不含上下文调整), 有 NumPy 时返回 ndarray
+        """
+        advances = self.advances
+        if np is not None:
+            codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+            bmp = codepoints < BMP_SIZE
+            widths = self._np_advances[np.where(bmp, codepoints, 0)]
+            if not bmp.all():
+                for i in np.flatnonzero(~bmp):
+                    widths[i] = self._astral_advances.get(int(codepoints[i]), math.nan)
+            if np.isnan(widths).any():
+                missing = sorted({int(c) for c in codepoints[np.isnan(widths)]})
+                raise KeyError(*missing)
+            return widths
+        astral = self._astral_advances
+        widths = [advances[c] if c < BMP_SIZE else astral.get(c, math.nan) for c in map(ord, text)]
+        if any(w != w for w in widths):
+            raise KeyError(*sorted({ord(c) for c, w in zip(text, widths) if w != w}))
+        return widths
+
+    def measure_many(self, texts: Iterable[str]) -> list[Sequence[float]]:
+        texts = list(texts)
+        if np is None or not texts:
+            return [self.measure(text) for text in texts]
+        widths = self.measure(''.join(texts))
+        return np.split(widths, np.cumsum([len(text) for text in texts[:-1]]))
 
     def set_size(self, size):
         self.size = size
+        self._rate = size / self.metrics.units_per_em
         self._imf = None
+        self._advances = None
+        self._pil_lengths = {}
+
+
+class FontRegistry:
+    """
+    进程内共享的字体注册表, 以 (path, size, offset) 为键缓存 Font, 同一字体文件只解析一次, 只保留 FontMetrics.
+    注册表返回的 Font 会被多个线程共享, 不要对其调用 set_size.
+    """
+
+    def __init__(self):
+        self._fonts: dict[tuple, Font] = {}
+        self._metrics: dict[str, FontMetrics] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, font: str | PathLike, size=20, offset: tuple[int, int] = None) -> Font:
+        path = os.fspath(font)
+        key = (path, size, None if offset is None else tuple(offset))
+        with self._lock:
+            if (f := self._fonts.get(key)) is not None:
+                self.hits += 1
+                return f
+            self.misses += 1
+            f = Font(font, size=size, offset=offset, metrics=self._metrics.get(path))
+            self._metrics.setdefault(path, f.metrics)
+            self._fonts[key] = f
+            return f
+
+    def warm_up(self, specs: Iterable[tuple]):
+        """
+        预加载 (path, size, offset) 列表中的字体, 包括字体度量和 FreeType 句柄, 适合在 worker 启动时调用
+        """
+        fonts = [self.get(*spec) for spec in specs]
+        for font in fonts:
+            _ = font.imf
+        return fonts
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'fonts': len(self._fonts), 'files': len(self._metrics)}
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+            self._metrics.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+font_registry = FontRegistry()
+
+
+def get_font(font: str | PathLike, size=20, offset: tuple[int, int] = None) -> Font:
+    return font_registry.get(font, size=size, offset=offset)
+
+
+def sum_advances(advances: Sequence[float], text: str, spacing: float = 0):
+    """
+    按 Text 的规则累加字形宽度: 半角字符的间距为 spacing / 4, 最后一个字符的间距不计入.
+    长文本在有 NumPy 时用 cumsum 计算, 与逐个相加的结果完全一致.
+    """
+    if not text:
+        return 0
+    if np is not None and len(text) >= NUMPY_MIN_LENGTH:
+        halfwidth = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32) < 0x80
+        gaps = np.where(halfwidth, spacing / 4, spacing)
+        return float(np.cumsum(np.asarray(advances, dtype=np.float64) + gaps)[-1] - gaps[-1])
+    x = 0
+    last_spacing = 0
+    for char, _len in zip(text, advances):
+        last_spacing = spacing / 4 if char < '\x80' else spacing
+        x += _len + last_spacing
+    return x - last_spacing
+
+
+class GlyphCache(LRUCache):
+    """
+    渲染好的字形 alpha 蒙版缓存, 以 (字体文件, 字号, codepoint) 为键, 按蒙版占用的字节数做 LRU 淘汰.
+    命中时字形按整数像素贴到画布上, 与 draw.text 的亚像素位置最多相差半个像素.
+    """
+
+    # rough per-entry overhead, so that empty glyphs such as spaces are not free
+    ENTRY_OVERHEAD = 64
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__(maxcost=max_bytes, cost=self._glyph_cost)
+
+    @classmethod
+    def _glyph_cost(cls, glyph):
+        mask, _ = glyph
+        return cls.ENTRY_OVERHEAD + (mask.width * mask.height if mask is not None else 0)
+
+    def get_glyph(self, font: Font, char: str) -> tuple[Image.Image | None, tuple[int, int]]:
+        return self.get_or_create((os.fspath(font.font), font.size, ord(char)), lambda: self.render(font, char))
+
+    @staticmethod
+    def render(font: Font, char: str) -> tuple[Image.Image | None, tuple[int, int]]:
+        left, top, right, bottom = font.imf.getbbox(char)
+        if right <= left or bottom <= top:
+            return None, (0, 0)
+        mask = Image.new('L', (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text((-left, -top), char, font=font.imf, fill=255)
+        return mask, (left, top)
+
+
+glyph_cache: GlyphCache | None = None
+
+
+def merge_runs(glyphs: Iterable[tuple[str, Font, float, float]]) -> list[tuple[Font, str, tuple[float, float]]]:
+    """
+    把字形合并成可以用一次 draw.text 画出的片段 (font, text, (x, y)).
+    片段内按 Pillow 自身字宽累计的位置与排版位置相差超过半个像素时, 从该字形另起一段.
+    """
+    runs = []
+    run_font, run_text, run_xy, pen = None, '', (0, 0), 0
+    for word, font, gx, gy in glyphs:
+        if (font is run_font and gy == run_xy[1] and abs(pen - gx) <= 0.5 and not font.kerning
+                and word != '\n' and run_text[-1] != '\n'):
+            run_text += word
+        else:
+            if run_text:
+                runs.append((run_font, run_text, run_xy))
+            run_font, run_text, run_xy, pen = font, word, (gx, gy), gx
+        pen += font.get_pil_length(word)
+    if run_text:
+        runs.append((run_font, run_text, run_xy))
+    return runs
+
+
+def draw_glyphs(draw: ImageDraw, glyphs: Iterable[tuple[str, Font, float, float]], fill: tuple[int, int, int]):
+    """
+    在 (x, y) 处绘制字形. 开启字形缓存时贴缓存的蒙版, 否则按片段调用 draw.text.
+    """
+    cache = glyph_cache
+    if cache is None or draw.fontmode != 'L':
+        for font, text, xy in merge_runs(glyphs):
+            draw.text(xy, text, font=font.imf, fill=fill)
+        return
+    for word, font, gx, gy in glyphs:
+        if word == '\n':  # draw.text treats it as an empty multiline text
+            continue
+        mask, (left, top) = cache.get_glyph(font, word)
+        if mask is not None:
+            draw.bitmap((round(gx) + left, round(gy) + top), mask, fill=fill)
+
+
+def enable_glyph_cache(max_bytes: int = 64 * 1024 * 1024) -> GlyphCache:
+    """
+    开启字形缓存, 之后 Text.draw 会贴缓存的蒙版而不是每次调用 FreeType 渲染
+    """
+    global glyph_cache
+    glyph_cache = GlyphCache(max_bytes)
+    return glyph_cache
+
+
+def disable_glyph_cache():
+    global glyph_cache
+    glyph_cache = None
+
+
+class MissingGlyphError(Exception):
+    def __init__(self, codepoints: Iterable[int]):
+        self.codepoints = sorted(set(codepoints))
+        super().__init__(f'Can not find {", ".join(f"{chr(c)}:{c}" for c in self.codepoints)} in fonts')
+
+
+class FontChain:
+    """
+    字体回退链. 构建时把各字体的覆盖范围合并成 codepoint -> 字体序号的索引, 排在前面的字体优先.
+    可以像 list[Font] 一样迭代和索引.
+    """
+
+    def __init__(self, fonts: Iterable[Font]):
+        self.fonts = list(fonts)
+        if len(self.fonts) > 255:
+            raise ValueError('Too many fonts in one chain')
+        # 0 means no font in the chain covers the codepoint, otherwise it is the font index + 1
+        index = bytearray(BMP_SIZE)
+        astral = {}
+        for i in range(len(self.fonts), 0, -1):
+            for codepoint in self.fonts[i - 1].metrics.codepoints():
+                if codepoint < BMP_SIZE:
+                    index[codepoint] = i
+                else:
+                    astral[codepoint] = i
+        self._index = bytes(index)
+        self._astral = astral
+        self._slots = [None, *self.fonts]
+
+    @classmethod
+    def of(cls, fonts: Iterable[Font]) -> 'FontChain':
+        if isinstance(fonts, cls):
+            return fonts
+        return _font_chain(tuple(fonts))
+
+    def font_for(self, char: str) -> Font:
+        codepoint = ord(char)
+        i = self._index[codepoint] if codepoint < BMP_SIZE else self._astral.get(codepoint, 0)
+        if not i:
+            raise MissingGlyphError([codepoint])
+        return self._slots[i]
+
+    def lookup(self, text: str) -> list[int]:
+        """
+        返回每个字符所用字体的序号, 缺字时抛出列出全部缺失字符的 MissingGlyphError
+        """
+        index, astral = self._index, self._astral
+        slots = [index[c] if c < BMP_SIZE else astral.get(c, 0) for c in map(ord, text)]
+        if 0 in slots:
+            raise MissingGlyphError(ord(c) for c, i in zip(text, slots) if not i)
+        return [i - 1 for i in slots]
+
+    def runs(self, text: str) -> list[tuple[Font, int, int]]:
+        """
+        把字符串切分成使用同一字体的连续片段 (font, start, end)
+        """
+        runs = []
+        start = 0
+        for i, group in itertools.groupby(self.lookup(text)):
+            end = start + len(list(group))
+            runs.append((self.fonts[i], start, end))
+            start = end
+        return runs
+
+    def __iter__(self):
+        return iter(self.fonts)
+
+    def __len__(self):
+        return len(self.fonts)
+
+    def __getitem__(self, item):
+        return self.fonts[item]
+
+    def __repr__(self):
+        return f'FontChain({self.fonts!r})'
+
+
+@functools.lru_cache(maxsize=64)
+def _font_chain(fonts: tuple[Font, ...]) -> FontChain:
+    return FontChain(fonts)
+
+
+def get_advance(font: Font, text: str, classes: bytes, i: int):
+    """
+    计算 text[i] 在上下文中的排版宽度和绘制偏移, 只取决于前一个和后两个字符. classes 为 classify(text)
+    """
+    offset_x = 0
+    _len = font.get_char_width(text[i])
+    n = len(text)
+    c = classes[i]
+    # Chinese optimization
+    if i == 0 and c & LINE_START_HALF:
+        _len = _len / 2
+        offset_x = -_len
+    elif i + 1 == n and c & LINE_END_HALF:
+        _len = _len / 2
+    if i + 1 < n:
+        nc = classes[i + 1]
+        if c & CLOSING_PUNCT and nc & OPENING_PUNCT:
+            _len = _len / 2
+        if c & CHINESE and nc & ALPHA:
+            _len += font.size / 4
+        elif c & ALPHA and nc & CHINESE:
+            _len += font.size / 4
+        elif i + 2 < n and c & CHINESE and nc & HALFWIDTH and classes[i + 2] & ALPHA:
+            _len += font.size / 4
+        elif i > 0 and classes[i - 1] & ALPHA and c & HALFWIDTH and nc & CHINESE:
+            _len += font.size / 4
+    return _len, offset_x
+
+
+@dataclass(frozen=True, slots=True)
+class Measurement:
+    width: float
+    height: float
+    # Text.texts: (word, font, advance, draw offset) for every glyph
+    texts: tuple[tuple[str, Font, float, tuple[float, float]], ...]
+    # advance plus the spacing after every glyph, width == sum(steps) - last spacing
+    steps: tuple[float, ...]
+
+    @property
+    def advances(self) -> tuple[float, ...]:
+        return tuple(_len for _, _, _len, _ in self.texts)
+
+
+def _measure(text: str, fonts: FontChain, spacing: float) -> Measurement:
+    classes = classify(text)
+    texts = []
+    steps = []
+    for font, start, end in fonts.runs(text):
+        for i in range(start, end):
+            _len, offset_x = get_advance(font, text, classes, i)
+            texts.append((text[i], font, _len, (offset_x, 0)))
+            steps.append(_len + (spacing / 4 if classes[i] & HALFWIDTH else spacing))
+    return Measurement(width=sum_advances([_len for _, _, _len, _ in texts], text, spacing),
+                       height=max((font.size for _, font, _, _ in texts), default=0),
+                       texts=tuple(texts), steps=tuple(steps))
+
+
+# (text, FontChain, spacing) -> Measurement, shared by every layout in the process.
+# measure_cache.stats() gives the hit rate, size it with ANYQUOTE_MEASURE_CACHE_GLYPHS
+measure_cache = LRUCache(maxcost=MEASURE_CACHE_GLYPHS, cost=lambda m: len(m.texts) + 1)
+
+
+def measure(text: str, fonts: Iterable[Font], spacing: float = 0) -> Measurement:
+    """
+    单独排版 text 的结果, 等价于 Text(text, fonts, spacing) 的宽度, 高度和字形, 结果会被缓存
+    """
+    fonts = FontChain.of(fonts)
+    return measure_cache.get_or_create((text, fonts, spacing), lambda: _measure(text, fonts, spacing))
 
 
 class Line:
     def __init__(self, text: str, fonts: [Font], spacing: int, align: str = 'left', max_width: int = math.inf,
                  symbol_push: bool = True, symbol_push_threshold: tuple[float, float] = (0.5, 1)):
+        self.fonts = FontChain.of(fonts)
+        self._text = ''
+        self._classes = b''
+        # spacing -> running advance of the settled glyphs, see get_length
+        self._settled: dict[float, list[float]] = {}
         self.text = text
         self.align = align
         self.max_width = max_width
-        self.fonts = fonts
         self.spacing = spacing
         self.symbol_push = symbol_push
         self.symbol_push_threshold = symbol_push_threshold
-        self.full_width_symbols = '，。、；：？！\'":《（【“”』'
+        self.full_width_symbols = FULL_WIDTH_SYMBOLS
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value: str):
+        old, self._text = self._text, value
+        if value.startswith(old) or old.startswith(value):
+            keep = max(0, min(len(old), len(value)) - 2) + 1
+            for xs in self._settled.values():
+                del xs[keep:]
+            self._classes = self._classes[:len(value)] + classify(value[len(old):])
+        else:
+            self._settled.clear()
+            self._classes = classify(value)
+
+    def get_length(self, extra: str = '', spacing: float = None):
+        """
+        等价于 Text(self.text + extra, fonts, spacing).get_length().
+        一个字形的宽度只取决于它前一个和后两个字符, 所以除最后两个字形外的累计宽度会被缓存, 每次只需重新计算末尾.
+        """
+        spacing = self.spacing if spacing is None else spacing
+        text, classes = self._text, self._classes
+        xs = self._settled.setdefault(spacing, [0])
+        k = len(xs) - 1
+        x = xs[-1]
+        while k < len(text) - 2:
+            x += self._step(text, classes, k, spacing)[0]
+            xs.append(x)
+            k += 1
+        # keep one settled character in front of the tail as context
+        start = max(k - 1, 0)
+        tail = text[start:] + extra
+        tail_classes = classes[start:] + classify(extra)
+        last_spacing = 0
+        j = k - start
+        if len(extra) >= MEASURE_MIN_LENGTH:
+            # apart from its first and last two glyphs, a long segment measures the same anywhere,
+            # so take those steps from the cached measurement of the segment alone
+            inner_start = len(tail) - len(extra) + 1
+            while j < inner_start:
+                x += self._step(tail, tail_classes, j, spacing)[0]
+                j += 1
+            for step in measure(extra, self.fonts, spacing).steps[1:-2]:
+                x += step
+            j = len(tail) - 2
+        for j in range(j, len(tail)):
+            step, last_spacing = self._step(tail, tail_classes, j, spacing)
+            x += step
+        x -= last_spacing
+        return x
+
+    def _step(self, text: str, classes: bytes, i: int, spacing: float):
+        _len, _ = get_advance(self.fonts.font_for(text[i]), text, classes, i)
+        if classes[i] & HALFWIDTH:
+            return _len + spacing / 4, spacing / 4
+        return _len + spacing, spacing
 
     def __iter__(self):
         return iter(self.text)
 
-    def draw(self, draw: ImageDraw, xy: tuple[int, int], fill: tuple[int, int, int]):
-        x, y = xy
-        if self.text == '':
-            return
+    def get_draw_text(self) -> tuple['Text', float]:
+        """
+        按对齐方式排好的 Text, 以及它相对行首的 x 偏移
+        """
         text = Text(text=self.text, fonts=self.fonts, spacing=self.spacing)
-        if self.align == 'left':
-            text.draw(draw, (x, y), fill)
-        elif self.align == 'center':
-            text.draw(draw, (int(x + (self.max_width - text.get_length()) / 2), y), fill)
+        if self.align == 'center':
+            return text, math.floor((self.max_width - text.get_length()) / 2)
         elif self.align == 'right':
-            text.draw(draw, (x + self.max_width - text.get_length(), y), fill)
-        elif self.align == 'justify':
-            words = list(self.text)
-            words_count = len(words)
-            if words_count == 1:
-                text.draw(draw, (x, y), fill)
-            else:
-                total_length = text.get_length()
-                hf_count = len(list(filter(is_halfwidth, words)))
-                count = words_count - hf_count
+            return text, self.max_width - text.get_length()
+        elif self.align == 'justify' and len(self.text) > 1:
+            classes = self._classes
+            words_count = len(classes)
+            total_length = text.get_length()
+            hf_count = count_class(classes, HALFWIDTH)
+            count = words_count - hf_count
 
-                if (diff := (self.max_width - total_length)) > 0:
-                    if is_halfwidth(self.text[-1]):
-                        q = 0.25
-                    else:
-                        q = 1
-                    space = diff / (hf_count / 4 + count - q)
-                    Text(text=self.text, fonts=self.fonts, spacing=space).draw(draw, (x, y), fill)
+            if (diff := (self.max_width - total_length)) > 0:
+                if classes[-1] & HALFWIDTH:
+                    q = 0.25
                 else:
-                    symbols = filter(lambda a: a in self.full_width_symbols, self.text)
-                    symbol_count = len(list(symbols))
-                    indentation = (-diff) / symbol_count
-                    texts = []
-                    for word, font, _len, font_offset in text.texts:
-                        if word in self.full_width_symbols:
-                            _len -= indentation
-                        texts.append((word, font, _len, font_offset))
-                    text.texts = texts
-                    text.draw(draw, (x, y), fill)
+                    q = 1
+                space = diff / (hf_count / 4 + count - q)
+                return Text(text=self.text, fonts=self.fonts, spacing=space), 0
+            symbol_count = count_class(classes, FULL_WIDTH_SYMBOL)
+            if symbol_count:  # a line without full-width symbols is left as it is
+                indentation = (-diff) / symbol_count
+                texts = []
+                for (word, font, _len, font_offset), c in zip(text.texts, classes):
+                    if c & FULL_WIDTH_SYMBOL:
+                        _len -= indentation
+                    texts.append((word, font, _len, font_offset))
+                text.texts = texts
+        return text, 0
+
+    def draw(self, draw: ImageDraw, xy: tuple[int, int], fill: tuple[int, int, int]):
+        x, y = xy
+        if self.text == '':
+            return
+        text, offset_x = self.get_draw_text()
+        text.draw(draw, (x + offset_x, y), fill)
 
     def getbbox(self):
+        measured = measure(self.text, self.fonts, self.spacing)
         if self.align == 'left':
-            return Text(text=self.text, fonts=self.fonts, spacing=self.spacing).getbbox()
-        elif self.align == 'right':
-            text = Text(text=self.text, fonts=self.fonts, spacing=self.spacing)
-            _, y = text.getbbox()
-            return self.max_width, y
-
-        elif self.align == 'center':
-            text = Text(text=self.text, fonts=self.fonts, spacing=self.spacing)
-            x, y = text.getbbox()
-            return self.max_width, y
-        elif self.align == 'justify':
-            text = Text(text=self.text, fonts=self.fonts, spacing=self.spacing)
-            x, y = text.getbbox()
-            return self.max_width, y
+            return measured.width, measured.height
+        elif self.align in ('right', 'center', 'justify'):
+            return self.max_width, measured.height
 
     def append(self, text: str):
-        if Text(text=self.text + text, fonts=self.fonts, spacing=self.spacing).get_length() <= self.max_width:
-            self.text += text
+        if self.get_length(text) <= self.max_width:
+            self._extend(text)
         else:
             if self.symbol_push:
-                symbols = filter(lambda x: x in self.full_width_symbols, self.text)
-                symbol_count = len(list(symbols))
+                symbol_count = count_class(self._classes, FULL_WIDTH_SYMBOL)
                 symbol_count = 0.01 if symbol_count == 0 else symbol_count
-                if (Text(text=text, fonts=self.fonts, spacing=0).get_length() / symbol_count <
+                if (measure(text, self.fonts).width / symbol_count <
                         1 - self.symbol_push_threshold[0]):
-                    self.text += text
+                    self._extend(text)
                     return
 
             raise EOFError('The text is too long to append')
 
+    def _extend(self, text: str):
+        # appending keeps every settled advance valid, so skip the checks in the text setter
+        self._text += text
+        self._classes += classify(text)
+
     def __repr__(self):
         return self.text
 
@@ -173,7 +962,7 @@ class Paragraph:
         self.max_width = max_width
         self.line_spacing = line_spacing
         self.spacing = spacing
-        self.fonts = fonts
+        self.fonts = fonts = FontChain.of(fonts)
         self.unfinished_line = Line('', fonts=fonts, spacing=0, align='left', max_width=max_width,
                                     symbol_push=symbol_push,
                                     symbol_push_threshold=symbol_push_threshold)
@@ -186,8 +975,7 @@ class Paragraph:
             self.new_line(text)
 
     def check(self, text: str):
-        return Text(text=self.unfinished_line.text + text, fonts=self.fonts,
-                    spacing=self.spacing).get_length() <= self.max_width
+        return self.unfinished_line.get_length(text, self.spacing) <= self.max_width
 
     def new_line(self, text: str = ''):
         self.unfinished_line.align = self.align
@@ -215,26 +1003,29 @@ class TextBox:
 
                  ):
         self.text = text
-        self.fonts = fonts
+        self.fonts = fonts = FontChain.of(fonts)
         self.max_width = max_width
         self.line_spacing = line_spacing
         self.spacing = spacing
         self.paragraphs = []
+        # report every missing character at once instead of failing on the first one
+        fonts.lookup(text.replace('\n', ''))
         self.full_width_symbols = '，。、；：？！:《（【“”』'
         self.symbols = self.full_width_symbols + '\'",.[](){}<>/\\'
         # split the text into paragraphs
-        for paragraph in map(lambda x: list(x), text.split('\n')):
+        for paragraph in text.split('\n'):
             # create a new paragraph
             p = Paragraph(line_spacing=line_spacing, spacing=spacing, fonts=fonts, max_width=max_width, align='justify',
                           symbol_push=symbol_push, symbol_push_threshold=symbol_push_threshold)
 
             word = ''
+            classes = classify(paragraph)
 
             for i, _char in enumerate(paragraph):
                 _char: str
 
                 # If the character is in the alphabet, add it as a word
-                if is_alpha(_char):
+                if classes[i] & ALPHA:
                     word += _char
 
                 else:
@@ -257,8 +1048,7 @@ class TextBox:
                         elif _char in self.symbols:
                             # if symbol_push is True, push the full-width symbol into small space
                             if symbol_push:
-                                symbols = filter(lambda x: x in self.full_width_symbols, p.unfinished_line.text)
-                                symbol_count = len(list(symbols))
+                                symbol_count = sum(map(p.unfinished_line.text.count, self.full_width_symbols))
                                 symbol_count = 0.01 if symbol_count == 0 else symbol_count
                                 if 1 / symbol_count < symbol_push_threshold[0]:
                                     p.add_text(_char)
@@ -296,105 +1086,162 @@ class TextBox:
                 p.add_text(word)
             self.paragraphs.append(p)
 
-    @property
-    def high(self):
-        _sum = 0
+    @functools.cached_property
+    def layout(self) -> 'TextLayout':
+        """
+        排版结果, 每行只排一次, high 和 draw 都从这里读取
+        """
+        fonts = list(self.fonts)
+        font_index = {font: i for i, font in enumerate(fonts)}
+        lines = []
+        y = 0
         for paragraph in self.paragraphs:
             for line in paragraph:
-                _sum += line.getbbox()[1]  # y
-                _sum += self.line_spacing
-            _sum -= self.line_spacing
-            _sum += self.line_spacing * 3
-        _sum -= self.line_spacing * 3
-        return _sum
-
-    def draw(self, draw: ImageDraw, x, y):
-        for paragraph in self.paragraphs:
-            for line in paragraph:
-                line.draw(draw, (x, y), (0, 0, 0))
-                y += line.getbbox()[1]  # text.getbbox()[1] is the height of the text
+                text, offset_x = line.get_draw_text()
+                glyphs = text.get_glyphs((offset_x, 0)) if line.text else []
+                width, height = line.getbbox()
+                lines.append(LineLayout(text=''.join(word for word, _, _, _ in glyphs),
+                                        fonts=tuple(font_index[font] for _, font, _, _ in glyphs),
+                                        xs=tuple(gx for _, _, gx, _ in glyphs),
+                                        ys=tuple(gy for _, _, _, gy in glyphs),
+                                        width=width, height=height, y=y))
+                y += height
                 y += self.line_spacing
             y -= self.line_spacing
             y += self.line_spacing * 3
         y -= self.line_spacing * 3
+        return TextLayout(fonts=tuple(font.spec for font in fonts), lines=tuple(lines), height=y,
+                          _resolved=tuple(fonts))
+
+    @property
+    def high(self):
+        return self.layout.height
+
+    def draw(self, draw: ImageDraw, x, y):
+        self.layout.draw(draw, x, y, (0, 0, 0))
+
+
+@dataclass(frozen=True)
+class LineLayout:
+    text: str
+    # for every glyph: index into TextLayout.fonts and its draw position relative to the line
+    fonts: tuple[int, ...]
+    xs: tuple[float, ...]
+    ys: tuple[float, ...]
+    width: float
+    height: float
+    # top of the line relative to the text box
+    y: float
+
+
+@dataclass(frozen=True)
+class TextLayout:
+    """
+    不可变的排版结果. 字体以 (path, size, offset) 记录, 可以用 to_dict 序列化后在另一个进程里 draw.
+    """
+    fonts: tuple[tuple, ...]
+    lines: tuple[LineLayout, ...]
+    height: float
+    _resolved: tuple[Font, ...] = field(default=(), compare=False, repr=False)
+
+    def get_fonts(self) -> tuple[Font, ...]:
+        return self._resolved or tuple(font_registry.get(*spec) for spec in self.fonts)
+
+    def draw(self, draw: ImageDraw, x, y, fill: tuple[int, int, int] = (0, 0, 0), *,
+             rows: tuple[float, float] = None):
+        """
+        rows 为 (top, bottom) 时只绘制可能落在画布这几行内的行, 分段渲染时用来跳过其余的行
+        """
+        fonts = self.get_fonts()
+        for line in self.lines:
+            line_y = y + line.y
+            # glyphs may reach a little outside their line box, one line height of margin covers that
+            if rows is not None and (line_y + 2 * line.height < rows[0] or line_y - line.height >= rows[1]):
+                continue
+            draw_glyphs(draw, [(word, fonts[i], x + gx, line_y + gy)
+                               for word, i, gx, gy in zip(line.text, line.fonts, line.xs, line.ys)], fill)
+
+    def scaled(self, factor: float, fonts: Sequence[Font] = None) -> 'TextLayout':
+        """
+        按 factor 缩放的排版结果, 换行位置不变. fonts 为目标尺寸下对应的字体 (与 self.fonts 一一对应),
+        不传时按比例缩放字号
+        """
+        if fonts is not None:
+            fonts = tuple(fonts)
+            if len(fonts) != len(self.fonts):
+                raise ValueError(f'Expected {len(self.fonts)} fonts, got {len(fonts)}')
+            specs, resolved = tuple(font.spec for font in fonts), fonts
+        else:
+            specs = tuple((path, max(1, round(size * factor)), None if offset is None else
+                           tuple(v * factor * max(1, round(size * factor)) / size for v in offset))
+                          for path, size, offset in self.fonts)
+            resolved = ()
+        lines = tuple(LineLayout(text=line.text, fonts=line.fonts, xs=tuple(x * factor for x in line.xs),
+                                 ys=tuple(y * factor for y in line.ys), width=line.width * factor,
+                                 height=line.height * factor, y=line.y * factor) for line in self.lines)
+        return TextLayout(fonts=specs, lines=lines, height=self.height * factor, _resolved=resolved)
+
+    def to_dict(self) -> dict:
+        return {
+            'version': 1,
+            'fonts': [list(spec) for spec in self.fonts],
+            'lines': [{'text': line.text, 'fonts': list(line.fonts), 'xs': list(line.xs), 'ys': list(line.ys),
+                       'width': line.width, 'height': line.height, 'y': line.y} for line in self.lines],
+            'height': self.height,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TextLayout':
+        if data.get('version') != 1:
+            raise ValueError(f'Unsupported layout version: {data.get("version")}')
+        fonts = tuple((path, size, None if offset is None else tuple(offset)) for path, size, offset in data['fonts'])
+        lines = tuple(LineLayout(text=line['text'], fonts=tuple(line['fonts']), xs=tuple(line['xs']),
+                                 ys=tuple(line['ys']), width=line['width'], height=line['height'], y=line['y'])
+                      for line in data['lines'])
+        return cls(fonts=fonts, lines=lines, height=data['height'])
 
 
 class Text:  # blog: layout
     def __init__(self, text: str, fonts: list[Font], spacing: float = 0):
         self.text = text
-        self.fonts = fonts
+        self.fonts = FontChain.of(fonts)
         self.spacing = spacing
         # rander text
-        self.texts = []
-
-        for i, word in enumerate(text):
-            offset_x, offset_y = 0, 0
-            for font in self.fonts:
-                if ord(word) in font.best_cmap:
-                    _len = font.get_char_size(word)[0]
-                    # Chinese optimization
-                    if i == 0 and word in "《（【〔“":
-                        _len = _len / 2
-                        offset_x = -_len
-                    elif i == len(text) - 1 and word in "》）】〕”、。":
-                        _len = _len / 2
-                    if len(text) > i + 1:
-                        if word in "》）】，。、；：？！”" and text[i + 1] in "《（【，。、“":
-                            _len = _len / 2
-                        if is_chinese(word) and is_alpha(text[i + 1]):
-                            _len += font.size / 4
-                        elif is_alpha(word) and is_chinese(text[i + 1]):
-                            _len += font.size / 4
-                        elif len(text) > i + 2 and is_chinese(word) and is_halfwidth(text[i + 1]) and is_alpha(
-                                text[i + 2]):
-                            _len += font.size / 4
-                        elif i > 0 and is_alpha(text[i - 1]) and is_halfwidth(word) and is_chinese(text[i + 1]):
-                            _len += font.size / 4
-
-                    self.texts.append((word, font, _len, (offset_x, offset_y)))
-                    break
-            else:
-                raise Exception(f'Can not find {word}:{ord(word)} in fonts')
+        self.texts = list(measure(text, self.fonts, spacing).texts)
 
-    def draw(self, draw: ImageDraw, xy: tuple[int, int], fill: tuple[int, int, int]):
+    def get_positions(self, x: float = 0) -> list[float]:
+        """
+        每个字形的排版 x 坐标 (不含绘制偏移)
+        """
+        positions = []
+        spacing = self.spacing
+        for word, _, _len, _ in self.texts:
+            positions.append(x)
+            x += _len + (spacing / 4 if word < '\x80' else spacing)
+        return positions
+
+    def get_glyphs(self, xy: tuple[float, float]) -> list[tuple[str, Font, float, float]]:
+        """
+        每个字形的绘制位置 (word, font, x, y), 已加上字体和标点的绘制偏移
+        """
         x, y = xy
-        for word, font, _len, font_offset in self.texts:
-            pil_font = font.imf
-            font_offset_x, font_offset_y = font_offset
-            offset_x, offset_y = font.offset if font.offset else (0, 0)
-            draw.text((x + offset_x + font_offset_x, y + offset_y + font_offset_y), word, font=pil_font, fill=fill)
-            if is_halfwidth(word):
-                x += _len + self.spacing / 4
-            else:
-                x += (_len + self.spacing)
+        glyphs = []
+        for (word, font, _len, (font_offset_x, font_offset_y)), pos in zip(self.texts, self.get_positions(x)):
+            offset_x, offset_y = font.offset
+            glyphs.append((word, font, pos + offset_x + font_offset_x, y + offset_y + font_offset_y))
+        return glyphs
+
+    def glyph_runs(self, xy: tuple[float, float]) -> list[tuple[Font, str, tuple[float, float]]]:
+        return merge_runs(self.get_glyphs(xy))
+
+    def draw(self, draw: ImageDraw, xy: tuple[int, int], fill: tuple[int, int, int]):
+        draw_glyphs(draw, self.get_glyphs(xy), fill)
 
     def getbbox(self):
-        x, y = 0, 0
-        last_spacing = 0
-        for word, font, _len, _ in self.texts:
-            if is_halfwidth(word):
-                x += _len + self.spacing / 4
-                last_spacing = self.spacing / 4
-            else:
-                x += (_len + self.spacing)
-                last_spacing = self.spacing
-            y = max(y, font.size)
-        x -= last_spacing
-        return x, y
+        return self.get_length(), max((font.size for _, font, _, _ in self.texts), default=0)
 
     def get_length(self):
-        x = 0
-        last_spacing = 0
-        for word, font, _len, _ in self.texts:
-            if is_halfwidth(word):
-                x += _len + self.spacing / 4
-                last_spacing = self.spacing / 4
-            else:
-                x += (_len + self.spacing)
-                last_spacing = self.spacing
-        x -= last_spacing
-
-        return x
+        return sum_advances([_len for _, _, _len, _ in self.texts], self.text, self.spacing)
 
     def __repr__(self):
         return self.text
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+@File       : bench_bands.py
+
+@Author     : hsn
+
+@Date       : 2024/8/29 上午11:20
+
+在仓库根目录下运行: python -m benchmarks.bench_bands
+"""
+import subprocess
+import sys
+
+# 在新的解释器里把长文本 quote 编码成 PNG, 打印峰值 RSS (KiB), 耗时和图像尺寸
+PROBE = '''
+import os, resource, sys, time
+from datetime import datetime
+from PIL import Image
+from anyquote.rander.img import quote_to, warm_up
+from benchmarks.bench_layout import mixed_paragraph
+
+length, band_height = int(sys.argv[1]), sys.argv[2]
+warm_up()
+context = mixed_paragraph(length)
+avatar = Image.new('RGB', (150, 150), (200, 200, 200))
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+with open(os.devnull, 'wb') as f:
+    result = quote_to(f, 'hsn', avatar, context, datetime(2024, 8, 11), 'hsn8086',
+                      band_height=None if band_height == 'none' else int(band_height))
+elapsed = time.perf_counter() - start
+print(baseline, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, elapsed, result.size[1])
+'''
+
+
+def peak_rss(length: int, band_height: int = None):
+    """
+    返回 (渲染前的峰值 RSS, 渲染后的峰值 RSS, 耗时, 图像高度), RSS 单位为 KiB
+    """
+    result = subprocess.run([sys.executable, '-c', PROBE, str(length), str(band_height or 'none')],
+                            check=True, capture_output=True, text=True)
+    baseline, peak, elapsed, height = result.stdout.split()
+    return int(baseline), int(peak), float(elapsed), int(height)
+
+
+def main(lengths=(1000, 10000, 30000), band_height: int = 1024):
+    for length in lengths:
+        for bands in (None, band_height):
+            baseline, peak, elapsed, height = peak_rss(length, bands)
+            mode = f'bands of {bands} rows' if bands else 'whole canvas'
+            print(f'{length} chars ({height}px tall), {mode}: {elapsed * 1000:.0f} ms, '
+                  f'peak RSS +{(peak - baseline) / 1024:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_capture.py
+
+@Author     : hsn
+
+@Date       : 2024/8/28 上午11:20
+
+在仓库根目录下运行: python -m benchmarks.bench_capture
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from selenium.common import WebDriverException
+
+from anyquote.internet.pool import DriverPool
+from anyquote.internet.twi import capture_tweet_json
+
+FIXTURE = Path(__file__).parent.parent / 'tests' / 'fixtures' / 'TweetResultByRestId.json'
+# 1x1 的透明 PNG
+PIXEL = bytes.fromhex('89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4890000000d49444154789c6300010000'
+                      '0500010d0a2db40000000049454e44ae426082')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    模拟推文页面: 页面引用 assets 张图片, 内联脚本请求 TweetResultByRestId 接口
+    """
+    assets = 60
+
+    def do_GET(self):
+        if self.path.startswith('/status/'):
+            images = ''.join(f'<img src="/img/{i}.png">' for i in range(self.assets))
+            tweet_id = self.path.rsplit('/', 1)[-1]
+            # 同步请求, 保证旧做法在页面加载完成时也能在日志里找到响应
+            script = ("<script>const xhr = new XMLHttpRequest(); xhr.open('GET', "
+                      "'/i/api/graphql/stand-in/TweetResultByRestId?variables=%7B%22tweetId%22%3A%22"
+                      f"{tweet_id}%22%7D', false); xhr.send()</script>")
+            self._send('text/html', f'<html><body>{images}{script}</body></html>'.encode())
+        elif self.path.startswith('/img/'):
+            self._send('image/png', PIXEL)
+        elif 'TweetResultByRestId' in self.path:
+            self._send('application/json', FIXTURE.read_bytes())
+        else:
+            self.send_error(404)
+
+    def _send(self, content_type: str, body: bytes):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def scan_capture(driver, url: str):
+    """
+    旧的做法: 页面加载后遍历整个性能日志, 对每个 Network 事件都请求一次 body. 返回 (json, body 请求次数)
+    """
+    driver.get(url)
+    calls = 0
+    for packet in driver.get_log("performance"):
+        message = json.loads(packet.get("message")).get("message")
+        if "Network" in message.get("method"):
+            calls += 1
+            try:
+                resp = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': message["params"]["requestId"]})
+                j = json.loads(resp.get("body"))
+                if 'data' in j:
+                    return j, calls
+            except (json.JSONDecodeError, WebDriverException):
+                pass
+    raise Exception("No data found")
+
+
+def main(rounds: int = 10):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/status/1819902409319313541'
+    try:
+        with DriverPool(1) as pool, pool.lease() as driver:
+            # 预热一次, 排除浏览器缓存和首次连接的影响
+            scan_capture(driver, url)
+            for name, capture in [('scan', lambda: scan_capture(driver, url)[1]),
+                                  ('targeted', lambda: (capture_tweet_json(driver, url), 1)[1])]:
+                best = float('inf')
+                calls = 0
+                for _ in range(rounds):
+                    driver.get_log("performance")
+                    start = time.perf_counter()
+                    calls = capture()
+                    best = min(best, time.perf_counter() - start)
+                print(f'{name}: {best * 1000:.1f} ms, {calls} getResponseBody calls')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
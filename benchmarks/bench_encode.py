@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_encode.py
+
+@Author     : hsn
+
+@Date       : 2024/9/3 下午4:25
+
+在仓库根目录下运行: python -m benchmarks.bench_encode
+"""
+import io
+import time
+from datetime import datetime
+
+from PIL import Image
+
+from anyquote import quote, warm_up
+from anyquote.rander.img import quote_to
+from benchmarks.bench_layout import mixed_paragraph
+
+SETTINGS = [
+    ('png', {}),
+    ('png', {'compress_level': 6}),
+    ('webp', {}),
+    ('webp', {'lossless': False}),
+    ('jpeg', {}),
+]
+
+
+def main(length: int = 1000, rounds: int = 3):
+    warm_up()
+    kwargs = dict(user_name='hsn', user_avatar=Image.new('RGB', (150, 150), (200, 10, 10)),
+                  context=mixed_paragraph(length), _time=datetime.now(), user_id='hsn8086',
+                  source='https://x.com/B_cat38324/status/1819902409319313541')
+
+    best = float('inf')
+    for _ in range(rounds):
+        buffer = io.BytesIO()
+        img = quote(**kwargs)
+        start = time.perf_counter()
+        img.save(buffer, 'PNG')
+        best = min(best, time.perf_counter() - start)
+    print(f'quote() + default PNG save: {len(buffer.getvalue())} bytes, encode {best * 1000:.1f} ms')
+
+    for fmt, options in SETTINGS:
+        results = [quote_to(io.BytesIO(), format=fmt, **options, **kwargs) for _ in range(rounds)]
+        encode = min(result.encode_time for result in results)
+        print(f'{fmt} {options}: {results[0].bytes} bytes, encode {encode * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
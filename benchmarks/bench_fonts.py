@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+@File       : bench_fonts.py
+
+@Author     : hsn
+
+@Date       : 2024/8/28 下午2:40
+
+在仓库根目录下运行: python -m benchmarks.bench_fonts
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+# 在新的解释器里加载 quote() 的全部字体, 打印加载前后的 RSS (KiB) 和耗时
+PROBE = '''
+import gc, time
+from anyquote.rander import img
+
+def rss():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+
+before = rss()
+start = time.perf_counter()
+img.warm_up()
+elapsed = time.perf_counter() - start
+gc.collect()
+print(before, rss(), elapsed)
+'''
+
+
+def load_fonts_rss(env: dict = None):
+    """
+    返回 (加载前 RSS, 加载后 RSS, 加载耗时), RSS 单位为 KiB
+    """
+    result = subprocess.run([sys.executable, '-c', PROBE], check=True, capture_output=True, text=True, env=env)
+    before, after, elapsed = result.stdout.split()
+    return int(before), int(after), float(elapsed)
+
+
+def report(name: str, before: int, after: int, elapsed: float):
+    print(f'{name}: warm_up() {elapsed * 1000:.0f} ms, RSS {before / 1024:.1f} MiB -> {after / 1024:.1f} MiB '
+          f'(+{(after - before) / 1024:.1f} MiB for fonts)')
+
+
+def main(rounds: int = 3):
+    # an empty metrics cache: the first worker parses the fonts and writes the cache, the others mmap it
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, 'ANYQUOTE_CACHE_DIR': directory}
+        report('first worker', *load_fonts_rss(env))
+        report('next workers', *min(load_fonts_rss(env) for _ in range(rounds)))
+
+
+if __name__ == '__main__':
+    main()
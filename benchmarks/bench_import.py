@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_import.py
+
+@Author     : hsn
+
+@Date       : 2024/8/27 上午10:05
+
+在仓库根目录下运行: python -m benchmarks.bench_import
+"""
+import subprocess
+import sys
+import time
+
+# 只渲染的进程不应加载的抓取依赖
+FETCH_MODULES = ('selenium', 'qrcode', 'twitter', 'webdriver_manager', 'requests')
+STATEMENT = 'from anyquote import quote'
+
+
+def cold_import(statement: str = STATEMENT):
+    """
+    在新的解释器里执行 statement, 返回 (耗时, 被加载的抓取依赖)
+    """
+    probe = (f'import sys; {statement}; '
+             f'print(",".join(m for m in {FETCH_MODULES!r} if m in sys.modules))')
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', probe], check=True, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    loaded = result.stdout.strip()
+    return elapsed, loaded.split(',') if loaded else []
+
+
+def main(rounds: int = 5, budget_ms: float = 400):
+    baseline = min(cold_import('pass')[0] for _ in range(rounds))
+    best, loaded = min(cold_import() for _ in range(rounds))
+    cost = (best - baseline) * 1000
+    print(f'{STATEMENT!r}: {cost:.1f} ms over interpreter startup, fetch modules loaded: {loaded or "none"}')
+    if loaded or cost > budget_ms:
+        print(f'cold-start budget exceeded ({budget_ms:.0f} ms, no fetch modules)')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(budget_ms=float(sys.argv[1]))
+    else:
+        main()
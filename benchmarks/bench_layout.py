@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_layout.py
+
+@Author     : hsn
+
+@Date       : 2024/8/25 下午3:12
+
+在仓库根目录下运行: python -m benchmarks.bench_layout
+"""
+import random
+import time
+
+from anyquote.rander.img import Zoomer, load_fonts
+from anyquote.rander.text import TextBox, measure_cache
+
+
+def mixed_paragraph(length: int, seed: int = 0):
+    """
+    生成中英混排的长段落
+    """
+    rnd = random.Random(seed)
+    cjk = '我们的生活是一个有趣的过程在这里大家都很开心今天天气很好'
+    words = ['hello', 'world', 'Python', 'quote', 'layout', '2024']
+    parts = []
+    size = 0
+    while size < length:
+        r = rnd.random()
+        if r < 0.55:
+            part = rnd.choice(cjk)
+        elif r < 0.75:
+            part = rnd.choice(words)
+        elif r < 0.9:
+            part = ' '
+        else:
+            part = rnd.choice('，。、；：？！“”')
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)[:length]
+
+
+def main(length: int = 10000, rounds: int = 3):
+    zoomer = Zoomer(0.5)
+    font_zoomer = Zoomer(zoomer(90))
+    fonts_context, _, _ = load_fonts(font_zoomer)
+    text = mixed_paragraph(length)
+    best = float('inf')
+    for _ in range(rounds):
+        measure_cache.clear()
+        start = time.perf_counter()
+        TextBox(text=text, fonts=fonts_context, max_width=zoomer(1800), line_spacing=font_zoomer(1 / 3),
+                spacing=font_zoomer(1 / 6), symbol_push=True).layout
+        best = min(best, time.perf_counter() - start)
+    print(f'layout {length} chars: {best * 1000:.1f} ms ({length / best:.0f} chars/s)')
+
+    # the same text again, e.g. another size of one tweet, measures through the shared cache
+    start = time.perf_counter()
+    TextBox(text=text, fonts=fonts_context, max_width=zoomer(1800), line_spacing=font_zoomer(1 / 3),
+            spacing=font_zoomer(1 / 6), symbol_push=True).layout
+    stats = measure_cache.stats()
+    print(f'repeated layout: {(time.perf_counter() - start) * 1000:.1f} ms, '
+          f'measure cache hit rate {stats["hit_rate"]:.1%} ({stats["size"]} entries, {stats["cost"]} glyphs)')
+
+
+if __name__ == '__main__':
+    main()
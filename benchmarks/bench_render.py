@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#   Copyright (C) 2024. Suto-Commune
+#   _
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#   _
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#   _
+#   You should have received a copy of the GNU Affero General Public License
+#   along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_render.py
+
+@Author     : hsn
+
+@Date       : 2024/8/25 下午4:05
+
+在仓库根目录下运行: python -m benchmarks.bench_render
+"""
+import time
+from datetime import datetime
+
+from PIL import Image
+
+from anyquote import quote, warm_up
+from anyquote.rander import text as rander_text
+from benchmarks.bench_layout import mixed_paragraph
+
+
+def bench(text: str, rounds: int):
+    avatar = Image.new('RGB', (400, 400), (200, 10, 10))
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        quote(user_name='hsn', user_avatar=avatar, context=text, _time=datetime.now(), user_id='hsn8086',
+              source='https://x.com/B_cat38324/status/1819902409319313541')
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(length: int = 2000, rounds: int = 3):
+    warm_up()
+    text = mixed_paragraph(length)
+    print(f'quote {length} chars: {bench(text, rounds) * 1000:.1f} ms')
+    cache = rander_text.enable_glyph_cache()
+    try:
+        print(f'quote {length} chars, glyph cache: {bench(text, rounds) * 1000:.1f} ms, {cache.stats()}')
+    finally:
+        rander_text.disable_glyph_cache()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,8 +23,20 @@
 
 @Date       : 2024/8/11 下午8:43
 """
+import os
+import tempfile
 import unittest
 from datetime import datetime
+from unittest import mock
+
+
+def setUpModule():
+    # 字体度量等磁盘缓存写到临时目录, 不污染 ~/.cache/anyquote
+    directory = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(directory.cleanup)
+    env = mock.patch.dict(os.environ, ANYQUOTE_CACHE_DIR=directory.name)
+    env.start()
+    unittest.addModuleCleanup(env.stop)
 
 
 class Test(unittest.TestCase):
@@ -35,6 +47,828 @@ class Test(unittest.TestCase):
         img = Image.new("RGB", (128, 128))
         quote(user_name='hsn', user_avatar=img, context='Hello World', _time=datetime.now(), user_id='@hsn8086')
 
+    def test_font_registry(self):
+        from pathlib import Path
+        import anyquote
+        from anyquote.rander.text import FontRegistry
+
+        path = Path(anyquote.__file__).parent / 'assets' / 'NotoEmoji-VariableFont_wght.ttf'
+        registry = FontRegistry()
+        font = registry.get(path, size=45)
+        self.assertIs(registry.get(path, size=45), font)
+        self.assertIs(registry.get(path, size=54).metrics, font.metrics)
+        self.assertEqual(registry.stats(), {'hits': 1, 'misses': 2, 'fonts': 2, 'files': 1})
+
+    def test_font_metrics(self):
+        from pathlib import Path
+        from fontTools.ttLib import TTFont
+        import anyquote
+        from anyquote.rander.text import Font, FontMetrics
+
+        path = Path(anyquote.__file__).parent / 'assets' / 'NotoEmoji-VariableFont_wght.ttf'
+        metrics = FontMetrics.load(path)
+        with TTFont(path) as ttf:
+            self.assertEqual(metrics, FontMetrics.from_ttf(ttf))
+            cmap, hmtx, units_per_em = ttf.getBestCmap(), ttf['hmtx'].metrics, ttf['head'].unitsPerEm
+        font = Font(path, size=45, metrics=metrics)
+        for char in '#😀❤':
+            self.assertEqual(font.get_char_width(char), hmtx[cmap[ord(char)]][0] * 45 / units_per_em)
+        self.assertEqual(sorted(metrics.codepoints()), sorted(cmap))
+        with self.assertRaises(KeyError):
+            font.get_char_width('你')
+
+    def test_font_metrics_cache(self):
+        import os
+        import shutil
+        import tempfile
+        from pathlib import Path
+        from unittest import mock
+        import anyquote
+        from anyquote.rander import text
+
+        source = Path(anyquote.__file__).parent / 'assets' / 'NotoEmoji-VariableFont_wght.ttf'
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(os.environ, ANYQUOTE_CACHE_DIR=directory):
+            font = Path(directory, 'font.ttf')
+            shutil.copy(source, font)
+            expected = text.FontMetrics.load(font)
+            with mock.patch.object(text.FontMetrics, 'load', wraps=text.FontMetrics.load) as load:
+                metrics = text.font_metrics(font)
+                self.assertEqual(metrics, expected)
+                self.assertIsInstance(metrics.advances, memoryview)
+                self.assertEqual(text.font_metrics(font), expected)
+                self.assertEqual(load.call_count, 1)
+
+                # same content with a new mtime is still a hit
+                os.utime(font, ns=(0, 0))
+                self.assertEqual(text.font_metrics(font), expected)
+                self.assertEqual(load.call_count, 1)
+
+                # changed content rebuilds the cache
+                with open(font, 'ab') as f:
+                    f.write(b'\0' * 4)
+                os.utime(font, ns=(0, 0))
+                self.assertEqual(text.font_metrics(font), expected)
+                self.assertEqual(load.call_count, 2)
+
+    def test_warm_up(self):
+        from PIL import Image
+        from anyquote import quote, warm_up
+        from anyquote.rander.text import font_registry
+
+        warm_up()
+        misses = font_registry.misses
+        quote(user_name='hsn', user_avatar=Image.new("RGB", (128, 128)), context='Hello World', _time=datetime.now())
+        self.assertEqual(font_registry.misses, misses)
+
+    def test_line_length(self):
+        from anyquote.rander.img import Zoomer, load_fonts
+        from anyquote.rander.text import Line, Text
+
+        fonts, _, _ = load_fonts(Zoomer(45))
+        line = Line('', fonts=fonts, spacing=0)
+        for part in ['《你好》', 'hello', '，', '世界', 'a', '。😀', ' ', '“test”']:
+            line.append(part)
+            for extra in ['', 'x', '中', '）。']:
+                for spacing in [0, 7]:
+                    self.assertEqual(line.get_length(extra, spacing),
+                                     Text(line.text + extra, fonts=fonts, spacing=spacing).get_length())
+        line.text = line.text[:5]
+        self.assertEqual(line.get_length('ab'), Text(line.text + 'ab', fonts=fonts).get_length())
+
+    def test_font_measure(self):
+        from anyquote.rander.img import Zoomer, load_fonts
+
+        font = load_fonts(Zoomer(45))[0][0]
+        text = '你好，world。'
+        self.assertEqual(list(font.measure(text)), [font.get_char_size(c)[0] for c in text])
+        self.assertEqual([len(w) for w in font.measure_many(['你好', '', 'abc'])], [2, 0, 3])
+        with self.assertRaises(KeyError):
+            font.measure('\U0010ffff')
+
+    def test_font_chain(self):
+        from anyquote.rander.img import Zoomer, load_fonts
+        from anyquote.rander.text import FontChain, MissingGlyphError
+
+        chain = load_fonts(Zoomer(45))[0]
+        self.assertIs(FontChain.of(list(chain)), FontChain.of(list(chain)))
+        self.assertEqual([(chain.fonts.index(font), start, end) for font, start, end in chain.runs('ab😀😀c')],
+                         [(0, 0, 2), (1, 2, 4), (0, 4, 5)])
+        with self.assertRaises(MissingGlyphError) as cm:
+            chain.lookup('a\U0010ffffb\U000e0001\U0010ffff')
+        self.assertEqual(cm.exception.codepoints, [0xe0001, 0x10ffff])
+
+    def test_glyph_runs(self):
+        from anyquote.rander.img import Zoomer, load_fonts
+        from anyquote.rander.text import Text
+
+        fonts = load_fonts(Zoomer(45))[0]
+        text = Text('hello 你好😀😀', fonts=fonts)
+        runs = text.glyph_runs((10, 20))
+        self.assertEqual(''.join(run_text for _, run_text, _ in runs), text.text)
+        self.assertLess(len(runs), len(text.text))
+        for _, run_text, (x, _) in runs:
+            i = text.text.index(run_text)
+            self.assertAlmostEqual(x, text.get_positions(10)[i] + text.texts[i][1].offset[0] + text.texts[i][3][0])
+
+    def test_classify(self):
+        from anyquote.rander import text as t
+
+        sample = 'aZ9 ,:，。《》“”〔〕你㐀好！😀\n\'"é'
+        classes = t.classify(sample)
+        self.assertEqual(len(classes), len(sample))
+        self.assertEqual(list(classes), [t.char_class(c) for c in sample])
+        for c, flags in zip(sample, classes):
+            cp = ord(c)
+            self.assertEqual(bool(flags & t.HALFWIDTH), cp < 0x80)
+            self.assertEqual(bool(flags & t.CHINESE), 0x3400 <= cp <= 0x4dbf or 0x4e00 <= cp <= 0x9faf)
+            self.assertEqual(bool(flags & t.ALPHA), c.isascii() and c.isalnum())
+            self.assertEqual(bool(flags & t.FULL_WIDTH_SYMBOL), c in t.FULL_WIDTH_SYMBOLS)
+        self.assertEqual(t.char_class('😀'), 0)
+        self.assertEqual(t.count_class(classes, t.ALPHA), 3)
+        self.assertEqual(t.count_class(classes, t.HALFWIDTH), sum(c < '\x80' for c in sample))
+
+    def test_measure_cache(self):
+        from anyquote.rander.img import Zoomer, load_fonts
+        from anyquote.rander.text import Line, Text, measure, measure_cache
+
+        fonts = load_fonts(Zoomer(45))[0]
+        text = 'quote 你好，world😀'
+        measured = measure(text, fonts, 7)
+        reference = Text(text, fonts, 7)
+        self.assertEqual(measured.width, reference.get_length())
+        self.assertEqual((measured.width, measured.height), reference.getbbox())
+        self.assertEqual(list(measured.texts), reference.texts)
+        self.assertEqual(measured.advances, tuple(_len for _, _, _len, _ in reference.texts))
+        hits = measure_cache.stats()['hits']
+        self.assertIs(measure(text, fonts, 7), measured)
+        self.assertEqual(measure_cache.stats()['hits'], hits + 1)
+
+        # long segments reuse the cached interior and still match measuring the whole line
+        line = Line('你好（', fonts, spacing=0)
+        for extra in ('internationalization。', '我们“abcdefgh”', 'Python3是'):
+            for spacing in (0, 7):
+                self.assertEqual(line.get_length(extra, spacing), Text(line.text + extra, fonts, spacing).get_length())
+
+    def test_glyph_cache(self):
+        from PIL import Image, ImageDraw
+        from anyquote.rander.img import Zoomer, load_fonts
+        from anyquote.rander.text import GlyphCache, Text, disable_glyph_cache, enable_glyph_cache
+
+        fonts = load_fonts(Zoomer(45))[0]
+        text = Text('你好你好。你好', fonts=fonts)  # whole-pixel positions, so the output is identical
+        expected = Image.new('RGB', (600, 100), (255, 255, 255))
+        text.draw(ImageDraw.Draw(expected), (10, 10), (0, 0, 0))
+        cache = enable_glyph_cache()
+        try:
+            img = Image.new('RGB', (600, 100), (255, 255, 255))
+            text.draw(ImageDraw.Draw(img), (10, 10), (0, 0, 0))
+        finally:
+            disable_glyph_cache()
+        self.assertEqual(img.tobytes(), expected.tobytes())
+        self.assertEqual(cache.stats()['misses'], 3)
+        self.assertEqual(cache.stats()['hits'], 4)
+
+        costs = [GlyphCache._glyph_cost(GlyphCache.render(fonts[0], char)) for char in 'aeo']
+        small = GlyphCache(max_bytes=sum(costs) - 1)
+        for char in 'aeo':
+            small.get_glyph(fonts[0], char)
+        self.assertLessEqual(small.total_cost, small.maxcost)
+        self.assertGreater(small.evictions, 0)
+
+    def test_text_layout(self):
+        import json
+        from PIL import Image, ImageDraw
+        from anyquote.rander.img import Zoomer, load_fonts
+        from anyquote.rander.text import TextBox, TextLayout
+
+        fonts = load_fonts(Zoomer(45))[0]
+        textbox = TextBox('你好，世界。hello world 😀' * 5 + '\n第二段', fonts=fonts, max_width=900, line_spacing=15,
+                          spacing=7)
+        layout = textbox.layout
+        self.assertIs(textbox.layout, layout)
+        self.assertEqual(textbox.high, layout.height)
+        self.assertEqual(layout.lines[-1].text, '第二段')
+
+        copy = TextLayout.from_dict(json.loads(json.dumps(layout.to_dict())))
+        self.assertEqual(copy, layout)
+        expected = Image.new('RGB', (1000, int(layout.height) + 100), (255, 255, 255))
+        textbox.draw(ImageDraw.Draw(expected), 50, 50)
+        img = Image.new('RGB', expected.size, (255, 255, 255))
+        copy.draw(ImageDraw.Draw(img), 50, 50)
+        self.assertEqual(img.tobytes(), expected.tobytes())
+
+    def test_rounded_rectangle_mask(self):
+        from anyquote.rander.img import rounded_rectangle_mask
+
+        mask = rounded_rectangle_mask((400, 300), 30)
+        self.assertIs(rounded_rectangle_mask((400, 300), 30), mask)
+        self.assertEqual(mask.size, (400, 300))
+        for corner in [(0, 0), (399, 0), (0, 299), (399, 299)]:
+            self.assertEqual(mask.getpixel(corner), 0)
+        for inside in [(200, 150), (30, 0), (0, 30), (399, 150), (200, 299)]:
+            self.assertEqual(mask.getpixel(inside), 255)
+
+    def test_qr_tile(self):
+        import qrcode
+        from qrcode.image.styledpil import StyledPilImage
+        from qrcode.image.styles.moduledrawers import RoundedModuleDrawer
+        from anyquote.rander.img import qr_tile
+
+        url = 'https://x.com/B_cat38324/status/1819902409319313541'
+        tile = qr_tile(url, 150)
+        self.assertIs(qr_tile(url, 150), tile)
+        self.assertIsNot(qr_tile(url, 150, 'square'), tile)
+        self.assertRaises(ValueError, qr_tile, url, 150, 'dots')
+
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L)
+        qr.add_data(url)
+        expected = qr.make_image(image_factory=StyledPilImage, module_drawer=RoundedModuleDrawer())
+        self.assertEqual(tile.tobytes(), expected.resize((150, 150)).tobytes())
+
+    def test_lazy_import(self):
+        from benchmarks.bench_import import cold_import
+
+        _, loaded = cold_import()
+        self.assertEqual(loaded, [])
+        _, loaded = cold_import('import anyquote; anyquote.quote; from anyquote.rander.img import qr_tile')
+        self.assertEqual(loaded, [])
+
+    def test_driver_pool(self):
+        import threading
+        from selenium.common import WebDriverException
+        from anyquote.internet.pool import DriverPool
+
+        class Driver:
+            def __init__(self):
+                self.resets = 0
+                self.closed = False
+
+            def quit(self):
+                self.closed = True
+
+        drivers = []
+
+        def factory():
+            drivers.append(Driver())
+            return drivers[-1]
+
+        def reset(driver):
+            driver.resets += 1
+
+        with DriverPool(2, factory=factory, reset=reset, max_uses=3) as pool:
+            with pool.lease() as first:
+                with pool.lease() as second:
+                    self.assertIsNot(first, second)
+                    self.assertRaises(TimeoutError, pool.acquire, 0.01)
+            self.assertEqual(first.resets, 1)
+            with pool.lease() as driver:
+                self.assertIn(driver, (first, second))
+            self.assertEqual(len(drivers), 2)
+
+            # 用满 max_uses 次后关闭, 出现 WebDriverException 时也关闭
+            for _ in range(3):
+                with pool.lease():
+                    pass
+            self.assertTrue(any(driver.closed for driver in drivers))
+            with self.assertRaises(WebDriverException):
+                with pool.lease() as broken:
+                    raise WebDriverException('crashed')
+            self.assertTrue(broken.closed)
+
+            # 等待中的线程在归还后拿到浏览器
+            held = [pool.acquire(), pool.acquire()]
+            got = []
+            waiter = threading.Thread(target=lambda: got.append(pool.acquire(5)))
+            waiter.start()
+            pool.release(held[0])
+            waiter.join()
+            self.assertEqual(got, [held[0]])
+            pool.release(held[1])
+            pool.release(got[0])
+
+            stats = pool.stats()
+            self.assertEqual(stats['in_use'], 0)
+            self.assertEqual(stats['leases'], 10)
+            self.assertGreater(stats['max_wait'], 0)
+            self.assertGreater(stats['utilisation'], 0)
+        self.assertTrue(all(driver.closed for driver in drivers))
+
+    def test_capture_tweet_json(self):
+        import json
+        from pathlib import Path
+        from anyquote.internet.twi import capture_tweet_json
+
+        fixture = (Path(__file__).parent / 'fixtures' / 'TweetResultByRestId.json').read_text(encoding='utf-8')
+
+        def event(method, request_id, url=None, **fields):
+            params = {'requestId': request_id}
+            if url:
+                params['request' if method == 'Network.requestWillBeSent' else 'response'] = {'url': url, **fields}
+            else:
+                params.update(fields)
+            return {'message': json.dumps({'message': {'method': method, 'params': params}})}
+
+        class Driver:
+            def __init__(self, logs, stale=()):
+                self.logs = [list(stale)]
+                self.pending = logs
+                self.bodies = []
+
+            def get(self, url):
+                self.logs = self.pending
+
+            def get_log(self, kind):
+                return self.logs.pop(0) if self.logs else []
+
+            def execute_cdp_cmd(self, cmd, args):
+                self.bodies.append(args['requestId'])
+                return {'body': fixture}
+
+        noise = [event('Network.responseReceived', f'img{i}', f'https://pbs.twimg.com/{i}.jpg') for i in range(50)]
+        noise += [event('Network.loadingFinished', f'img{i}') for i in range(50)]
+        def api(tweet_id):
+            return ('https://x.com/i/api/graphql/abc/TweetResultByRestId?variables=%7B%22tweetId%22%3A%22'
+                    f'{tweet_id}%22%2C%22withCommunity%22%3Afalse%7D')
+
+        # 上一个页面留下的响应和引用推文的响应都不能被当成结果
+        stale = [event('Network.responseReceived', 'old', api(1)), event('Network.loadingFinished', 'old')]
+        quoted = [event('Network.responseReceived', 'q', api(12)), event('Network.loadingFinished', 'q')]
+        # 响应在第一批日志里, 加载完成的事件在之后的轮询里才出现
+        driver = Driver([noise + quoted + [event('Network.responseReceived', '42.1', api(1))], [],
+                         [event('Network.loadingFinished', '42.10'), event('Network.loadingFinished', '42.1')]],
+                        stale=stale)
+        j = capture_tweet_json(driver, 'https://x.com/a/status/1', poll=0)
+        self.assertEqual(j, json.loads(fixture))
+        self.assertEqual(driver.bodies, ['42.1'])
+
+        self.assertRaises(TimeoutError, capture_tweet_json, Driver([noise]), 'https://x.com/a/status/1', timeout=0.05,
+                          poll=0.01)
+
+        # 匹配的请求失败时立即报错, 不等到超时
+        failed = Driver([noise + [event('Network.requestWillBeSent', '7', api(1)),
+                                  event('Network.loadingFailed', 'q', errorText='net::ERR_ABORTED'),
+                                  event('Network.loadingFailed', '7', errorText='net::ERR_CONNECTION_RESET')]])
+        with self.assertRaisesRegex(Exception, 'ERR_CONNECTION_RESET'):
+            capture_tweet_json(failed, 'https://x.com/a/status/1', timeout=1, poll=0.01)
+        limited = Driver([[event('Network.responseReceived', '8', api(1), status=429, statusText='Too Many Requests')]])
+        with self.assertRaisesRegex(Exception, '429 Too Many Requests'):
+            capture_tweet_json(limited, 'https://x.com/a/status/1', timeout=1, poll=0.01)
+
+    def test_get_tweet_info_http(self):
+        import io
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from pathlib import Path
+        from urllib.parse import parse_qs, urlsplit
+        from PIL import Image
+        import tempfile
+        from unittest import mock
+        from anyquote.internet import avatar
+        from anyquote.internet.graphql import GuestClient, new_session
+        from anyquote.internet.tweet import TweetCache, tweet_id_from_url
+        from anyquote.internet.twi import get_tweet_info_http
+
+        fixture = (Path(__file__).parent / 'fixtures' / 'TweetResultByRestId.json').read_text(encoding='utf-8')
+        avatar_png = io.BytesIO()
+        Image.new('RGB', (400, 400), (200, 10, 10)).save(avatar_png, 'PNG')
+        activations = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                activations.append(self.headers['Authorization'])
+                self.send(json.dumps({'guest_token': f'g{len(activations)}'}).encode())
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path.endswith('/TweetResultByRestId'):
+                    # 第一个 token 视为过期, 客户端应重新获取
+                    if self.headers['x-guest-token'] == 'g1':
+                        return self.send(b'{}', 403)
+                    variables = json.loads(parse_qs(url.query)['variables'][0])
+                    self.server.tweet_ids.append(variables['tweetId'])
+                    host = f'http://127.0.0.1:{self.server.server_port}'
+                    self.send(fixture.replace('https://pbs.twimg.com', host).encode())
+                else:
+                    self.send(avatar_png.getvalue())
+
+            def send(self, body, status=200):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.tweet_ids = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f'http://127.0.0.1:{server.server_port}'
+        try:
+            with tempfile.TemporaryDirectory() as tmp, \
+                    mock.patch.object(avatar, '_default_cache', avatar.AvatarCache(directory=tmp)):
+                client = GuestClient(new_session(), activate_url=f'{base}/activate.json', graphql_url=f'{base}/graphql')
+                url = 'https://x.com/B_cat38324/status/1819902409319313541?s=20'
+                cache = TweetCache()
+                for _ in range(2):
+                    user_name, user_id, user_avatar, context, medias, t = get_tweet_info_http(url, client=client,
+                                                                                             cache=cache)
+                    self.assertEqual((user_name, user_id), ('B猫', 'B_cat38324'))
+                    self.assertEqual(context, '今天天气很好，出去走走。Nice weather today 😀 ')
+                    self.assertEqual(user_avatar.size, (150, 150))
+                    self.assertEqual(len(medias), 1)
+                    self.assertEqual(t.year, 2024)
+                self.assertEqual(len(activations), 2)
+                # 第二次命中缓存, 只请求一次接口
+                self.assertEqual(server.tweet_ids, ['1819902409319313541'])
+                self.assertEqual(cache.stats()['hits'], 1)
+                get_tweet_info_http(url, client=client, cache=None)
+                self.assertEqual(len(server.tweet_ids), 2)
+        finally:
+            server.shutdown()
+        self.assertEqual(tweet_id_from_url('1819902409319313541'), '1819902409319313541')
+        self.assertRaises(ValueError, tweet_id_from_url, 'https://x.com/B_cat38324')
+
+    def test_tweet_cache(self):
+        import json
+        import tempfile
+        import time
+        from pathlib import Path
+        from anyquote.internet.tweet import MemoryTweetStore, SQLiteTweetStore, TweetCache, parse_tweet
+
+        fixture = json.loads((Path(__file__).parent / 'fixtures' / 'TweetResultByRestId.json').read_text('utf-8'))
+        tweet = parse_tweet(fixture['data']['tweetResult']['result'])
+        self.assertEqual(tweet.id, '1819902409319313541')
+        self.assertEqual(tweet.user_avatar_url,
+                         'https://pbs.twimg.com/profile_images/1627591553473007617/avatar.jpg')
+        self.assertFalse(hasattr(tweet, '__dict__'))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for store in [MemoryTweetStore(), SQLiteTweetStore(Path(tmp) / 'tweets.sqlite3')]:
+                cache = TweetCache(store, ttl=60)
+                fetched = []
+                fetch = lambda: fetched.append(1) or tweet
+                self.assertEqual(cache.get_or_fetch(tweet.id, fetch), tweet)
+                self.assertEqual(cache.get_or_fetch(tweet.id, fetch), tweet)
+                self.assertEqual(len(fetched), 1)
+
+                # 过期后重新抓取
+                store.put(tweet.id, tweet, time.time() - 1)
+                cache.get_or_fetch(tweet.id, fetch)
+                self.assertEqual(len(fetched), 2)
+            # 另一个连接 (例如另一个进程) 能读到同一份数据
+            shared = SQLiteTweetStore(Path(tmp) / 'tweets.sqlite3', maxsize=1)
+            self.assertEqual(TweetCache(shared).get(tweet.id), tweet)
+            other = parse_tweet({**fixture['data']['tweetResult']['result'], 'rest_id': '2'})
+            TweetCache(shared).put(other)
+            self.assertIsNone(shared.get(tweet.id))
+            store.close()
+            shared.close()
+
+    def test_tweet_batch_fetcher(self):
+        import copy
+        import json
+        from pathlib import Path
+        from unittest import mock
+        from anyquote.internet import twi
+        from anyquote.internet.tweet import TweetCache
+        from anyquote.internet.twi import TweetBatchFetcher
+
+        fixture = json.loads((Path(__file__).parent / 'fixtures' / 'TweetResultByRestId.json').read_text('utf-8'))
+
+        class Scraper:
+            calls = []
+
+            def tweets_by_ids(self, ids):
+                self.calls.append(list(ids))
+                results = []
+                for tweet_id in ids:
+                    if tweet_id == '404':
+                        results.append({})
+                        continue
+                    result = copy.deepcopy(fixture['data']['tweetResult']['result'])
+                    result['rest_id'] = tweet_id
+                    results.append({'result': result})
+                # 返回顺序不一定与请求一致
+                return [{'data': {'tweetResult': results[::-1]}}]
+
+        cache = TweetCache()
+        fetcher = TweetBatchFetcher(Scraper(), chunk_size=2, cache=cache)
+        urls = ['https://x.com/a/status/1', '2', 'https://x.com/a', 'https://x.com/b/status/404', '3', '1']
+        tweets = fetcher.fetch(urls)
+        self.assertEqual(Scraper.calls, [['1', '2'], ['404', '3']])
+        self.assertEqual([t.id for t in tweets if not isinstance(t, Exception)], ['1', '2', '3', '1'])
+        self.assertIsInstance(tweets[2], ValueError)
+        self.assertIsInstance(tweets[3], LookupError)
+
+        # 已缓存的推文不再请求
+        self.assertEqual([t.id for t in fetcher.fetch(['3', '4'])], ['3', '4'])
+        self.assertEqual(Scraper.calls[-1], ['4'])
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 5))
+
+        # 不传 fetcher 时, 相同 cookies 共用一个已登录的 Scraper
+        with mock.patch.object(twi, 'Scraper', side_effect=lambda **kwargs: Scraper()) as scraper, \
+                mock.patch.object(twi, '_default_fetchers', {}):
+            cookies = {'ct0': 'x', 'auth_token': 'y'}
+            twi.get_tweets_login(['5'], cookies=cookies)
+            twi.get_tweets_login(['6'], cookies=dict(reversed(cookies.items())))
+            self.assertIs(twi.get_tweet_fetcher(cookies), twi.get_tweet_fetcher(dict(cookies)))
+            self.assertEqual(scraper.call_count, 1)
+            self.assertIsNot(twi.get_tweet_fetcher('cookies.json'), twi.get_tweet_fetcher(cookies))
+            self.assertEqual(scraper.call_count, 2)
+
+    def test_avatar_cache(self):
+        import io
+        import os
+        import tempfile
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from unittest import mock
+        from PIL import Image
+        from requests import RequestException
+        from anyquote.internet.avatar import AvatarCache
+        from anyquote.internet.graphql import new_session
+        from anyquote.rander.img import avatar_size
+
+        jpeg = io.BytesIO()
+        Image.new('RGB', (400, 400), (200, 10, 10)).save(jpeg, 'JPEG')
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append((self.path, self.headers['If-None-Match']))
+                if self.headers['If-None-Match'] == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', str(len(jpeg.getvalue())))
+                self.end_headers()
+                self.wfile.write(jpeg.getvalue())
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}/avatar.jpg'
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                cache = AvatarCache(new_session(), directory=tmp)
+                img = cache.get(url)
+                self.assertEqual(img.size, (150, 150))
+                self.assertIs(cache.get(url), img)
+                # 新实例从磁盘读取, 不发请求
+                self.assertEqual(AvatarCache(new_session(), directory=tmp).get(url).tobytes(), img.tobytes())
+                self.assertEqual(requests, [('/avatar.jpg', None)])
+
+                stale = AvatarCache(new_session(), directory=tmp, max_age=0)
+                self.assertEqual(stale.get(url).tobytes(), img.tobytes())
+                self.assertEqual(requests[-1], ('/avatar.jpg', '"v1"'))
+                self.assertEqual(stale.stats()['revalidations'], 1)
+
+                # 重新验证时网络出错, 继续使用缓存的头像
+                with mock.patch.object(stale.session, 'get', side_effect=RequestException('offline')):
+                    self.assertEqual(stale.get(url).tobytes(), img.tobytes())
+                    with self.assertRaises(RequestException):
+                        stale.get(url + '?offline')
+
+                # 不同尺寸分别缓存
+                self.assertEqual(cache.get(url, avatar_size(width=2000)).size, (300, 300))
+                self.assertNotEqual(cache.path(url, 300), cache.path(url))
+                self.assertIs(cache.get(url), img)
+
+                # 超过磁盘上限时删除最久未使用的文件
+                small = AvatarCache(new_session(), directory=tmp, max_disk_bytes=os.path.getsize(cache.path(url)))
+                small.get(url + '?2')
+                self.assertFalse(cache.path(url).exists())
+                self.assertTrue(small.path(url + '?2').exists())
+        finally:
+            server.shutdown()
+
+    def test_quote_twitter_async(self):
+        import asyncio
+        import io
+        import json
+        import tempfile
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from pathlib import Path
+        from unittest import mock
+        from PIL import Image
+        from anyquote import quote_twitter_async
+        from anyquote.aio import IOLimiter
+        from anyquote.internet import avatar
+        from anyquote.internet.tweet import parse_tweet
+
+        png = io.BytesIO()
+        Image.new('RGB', (400, 400), (200, 10, 10)).save(png, 'PNG')
+        paths = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                paths.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(png.getvalue())))
+                self.end_headers()
+                self.wfile.write(png.getvalue())
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        fixture = (Path(__file__).parent / 'fixtures' / 'TweetResultByRestId.json').read_text(encoding='utf-8')
+        fixture = fixture.replace('https://pbs.twimg.com', f'http://127.0.0.1:{server.server_port}')
+        tweet = parse_tweet(json.loads(fixture)['data']['tweetResult']['result'])
+
+        def fetch(url):
+            time.sleep(0.05)
+            return tweet
+
+        async def main():
+            limiter = IOLimiter(total=4, per_host=2)
+            with ThreadPoolExecutor(2) as executor:
+                return await asyncio.gather(*(
+                    quote_twitter_async(f'https://x.com/a/status/{i}', fetch=fetch, executor=executor,
+                                        limiter=limiter) for i in range(3)))
+
+        try:
+            with tempfile.TemporaryDirectory() as tmp, \
+                    mock.patch.object(avatar, '_default_cache', avatar.AvatarCache(directory=tmp)):
+                images = asyncio.run(main())
+        finally:
+            server.shutdown()
+        self.assertEqual(len(images), 3)
+        self.assertTrue(all(img.mode == 'RGBA' for img in images))
+        self.assertEqual(sorted(set(paths)), ['/media/GT6x.jpg', '/profile_images/1627591553473007617/avatar.jpg'])
+        self.assertEqual(paths.count('/media/GT6x.jpg'), 3)
+
+    def test_io_limiter(self):
+        import asyncio
+        import threading
+        import time
+        from anyquote.aio import IOLimiter
+
+        limiter = IOLimiter(total=3, per_host=2)
+        lock = threading.Lock()
+        running = {'a': 0, 'b': 0, 'all': 0}
+        peak = dict(running)
+
+        def job(host):
+            with lock:
+                for key in (host, 'all'):
+                    running[key] += 1
+                    peak[key] = max(peak[key], running[key])
+            time.sleep(0.02)
+            with lock:
+                for key in (host, 'all'):
+                    running[key] -= 1
+
+        async def main():
+            await asyncio.gather(*(limiter.run(f'https://{host}/x', job, host) for host in 'ab' * 5))
+
+        asyncio.run(main())
+        # 在另一个事件循环中也能使用
+        asyncio.run(main())
+        self.assertEqual(peak, {'a': 2, 'b': 2, 'all': 3})
+
+        # requests queued for a busy host must not keep other hosts waiting
+        limiter = IOLimiter(total=3, per_host=1)
+        started = []
+
+        def slow(host):
+            started.append(host)
+            time.sleep(0.05)
+
+        async def one_busy_host():
+            await asyncio.gather(*(limiter.run(f'https://{host}/x', slow, host) for host in 'aaab'))
+
+        asyncio.run(one_busy_host())
+        self.assertEqual(started[:2], ['a', 'b'])
+
+    def test_quote_many(self):
+        import tempfile
+        from datetime import datetime
+        from pathlib import Path
+        from PIL import Image
+        from anyquote.batch import BatchRenderer, main
+
+        jobs = [{'user_name': 'hsn', 'user_avatar': Image.new('RGB', (150, 150)), 'context': '你好' * i,
+                 '_time': datetime(2024, 8, 11), 'user_id': 'hsn8086'} for i in range(1, 4)]
+        jobs.insert(1, {'user_name': 'hsn', 'context': None, '_time': '2024-08-11T20:00:00'})
+        with BatchRenderer(2, max_in_flight=2) as renderer:
+            results = dict(renderer.map(jobs))
+            stats = renderer.throughput()
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual([results[i].mode for i in (0, 2, 3)], ['RGBA'] * 3)
+        self.assertEqual((stats['quotes'], stats['failed']), (3, 1))
+        self.assertGreater(stats['quotes_per_second_per_core'], 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            jobs_file = Path(tmp) / 'jobs.jsonl'
+            jobs_file.write_text('{"user_name": "hsn", "context": "你好", "_time": "2024-08-11T20:00:00"}\n',
+                                 encoding='utf-8')
+            self.assertEqual(main([str(jobs_file), str(Path(tmp) / 'out'), '-j', '1']), 0)
+            self.assertEqual(Image.open(Path(tmp) / 'out' / '0.png').mode, 'RGBA')
+
+    def test_quote_to(self):
+        import io
+        from datetime import datetime
+        from PIL import Image
+        from unittest import mock
+        from anyquote import quote
+        from anyquote.rander import img as img_module
+        from anyquote.rander.img import quote_to
+
+        kwargs = dict(user_name='hsn', user_avatar=Image.new('RGB', (150, 150), (200, 10, 10)),
+                      context='你好，世界。hello world' * 5, _time=datetime(2024, 8, 11), user_id='hsn8086',
+                      source='https://x.com/B_cat38324/status/1819902409319313541')
+        expected = quote(**kwargs)
+        for fmt, options, mode in [('png', {}, 'RGBA'), ('webp', {}, 'RGBA'), ('webp', {'lossless': False}, 'RGBA'),
+                                   ('jpeg', {'background': (0, 0, 0)}, 'RGB')]:
+            buffer = io.BytesIO()
+            result = quote_to(buffer, format=fmt, **options, **kwargs)
+            self.assertEqual(result.bytes, len(buffer.getvalue()))
+            self.assertEqual(result.size, expected.size)
+            img = Image.open(io.BytesIO(buffer.getvalue()))
+            self.assertEqual((img.format, img.mode), (result.format, mode))
+            if fmt == 'png':
+                self.assertEqual(img.tobytes(), expected.tobytes())
+        self.assertEqual(img.getpixel((0, 0)), (0, 0, 0))
+        self.assertRaises(ValueError, quote_to, io.BytesIO(), format='gif', **kwargs)
+
+        # 白色背景的 jpeg 不生成蒙版; quality=0 不会被当成默认值
+        with mock.patch.object(img_module, 'rounded_rectangle_mask', wraps=img_module.rounded_rectangle_mask) as mask:
+            default = quote_to(io.BytesIO(), format='jpeg', **kwargs)
+            self.assertNotIn(default.size, [size for (size, _), _ in mask.call_args_list])
+        self.assertLess(quote_to(io.BytesIO(), format='jpeg', quality=0, **kwargs).bytes, default.bytes)
+
+    def test_quote_bands(self):
+        import io
+        from datetime import datetime
+        from PIL import Image
+        from anyquote import quote
+        from anyquote.rander.img import gen_rounded_corner_mask, quote_bands, quote_to
+
+        kwargs = dict(user_name='hsn', user_avatar=Image.new('RGB', (150, 150), (200, 10, 10)),
+                      context='你好，世界。hello world😀\n' * 20, _time=datetime(2024, 8, 11), user_id='hsn8086',
+                      source='https://x.com/B_cat38324/status/1819902409319313541')
+        expected = quote(**kwargs)
+        size, bands = quote_bands(band_height=100, **kwargs)
+        self.assertEqual(size, expected.size)
+        y = 0
+        for band in bands:
+            self.assertLessEqual(band.height, 100)
+            self.assertEqual(band.tobytes(), expected.crop((0, y, size[0], y + band.height)).tobytes())
+            y += band.height
+        self.assertEqual(y, size[1])
+
+        # 圆角只生成一次, 之后各段复用
+        misses = gen_rounded_corner_mask.cache_info().misses
+        for _ in quote_bands(band_height=100, **kwargs)[1]:
+            pass
+        self.assertEqual(gen_rounded_corner_mask.cache_info().misses, misses)
+
+        buffer = io.BytesIO()
+        result = quote_to(buffer, band_height=256, **kwargs)
+        self.assertEqual(result.bytes, len(buffer.getvalue()))
+        img = Image.open(io.BytesIO(buffer.getvalue()))
+        self.assertEqual((img.format, img.mode, img.size), ('PNG', 'RGBA', expected.size))
+        self.assertEqual(img.tobytes(), expected.tobytes())
+        self.assertRaises(ValueError, quote_to, io.BytesIO(), format='webp', band_height=256, **kwargs)
+
+    def test_quote_scale(self):
+        from datetime import datetime
+        from PIL import Image
+        from anyquote import quote
+        from anyquote.rander.img import Zoomer, load_fonts, quote_sizes
+        from anyquote.rander.text import TextBox
+
+        kwargs = dict(user_name='hsn 😀', user_avatar=Image.new('RGB', (150, 150), (200, 10, 10)),
+                      context='你好，世界😀 hello world' * 10, _time=datetime(2024, 8, 11), user_id='hsn8086',
+                      source='https://x.com/B_cat38324/status/1819902409319313541')
+        self.assertEqual(quote(**kwargs, width=400).width, 400)
+        self.assertEqual(quote(**kwargs, scale=0.25).width, 500)
+        self.assertRaises(ValueError, quote, **kwargs, scale=0.5, width=1000)
+
+        full, preview = quote_sizes(**kwargs, widths=[1000, 256])
+        self.assertEqual(full.tobytes(), quote(**kwargs).tobytes())
+        self.assertEqual(preview.width, 256)
+
+        fonts = load_fonts(Zoomer(45))[0]
+        layout = TextBox('你好，世界😀 hello world' * 10, fonts=fonts, max_width=900, line_spacing=15, spacing=7).layout
+        small = layout.scaled(0.5, load_fonts(Zoomer(22))[0])
+        self.assertEqual([line.text for line in small.lines], [line.text for line in layout.lines])
+        self.assertAlmostEqual(small.height, layout.height / 2)
+        self.assertEqual(small.fonts[0][1], 22)
+        self.assertEqual(layout.scaled(2).fonts[1][1], 90)
+
     def test_start(self):
         from anyquote import quote_twitter
         quote_twitter('https://x.com/B_cat38324/status/1819902409319313541')